@@ -13,6 +13,7 @@ from .arrays import (
     ndarange,
     difference1d,
     union1d,
+    subset,
     array_mapping,
     array_index,
 )
@@ -25,7 +26,15 @@ from .entropy import (
     relative_entropy,
 )
 from .scaling import normalise
+from .tables import (
+    table_expand,
+    table_product,
+    table_marginalise,
+    table_maximise,
+    table_normalise,
+)
 from .search import get_elimination_ordering, find_min_neighbours
+from .contraction import ContractionPlan, plan_contraction
 
 __all__ = [
     "normalise",
@@ -47,4 +56,12 @@ __all__ = [
     "ndarange",
     "union1d",
     "difference1d",
+    "subset",
+    "table_expand",
+    "table_product",
+    "table_marginalise",
+    "table_maximise",
+    "table_normalise",
+    "ContractionPlan",
+    "plan_contraction",
 ]
@@ -0,0 +1,312 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+from collections import Counter
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from .tables import table_marginalise, table_maximise, table_product
+
+
+class ContractionPlan:
+    """
+    An order in which to contract a set of tables, one pair at a time.
+
+    Contracting a set of tables multiplies them together and sums (or maxes) out
+    every variable not in the output. A variable is eliminated as soon as no other
+    table depends on it, so the size of the intermediate tables depends only on the
+    order in which pairs are contracted.
+
+    Operands are numbered as they are created: the input tables are 0 to n - 1, and
+    the i-th step of the 'path' contracts two operands into operand n + i. The
+    'scopes' of each operand are the variables left in it after elimination.
+    """
+
+    def __init__(
+        self,
+        inputs: List[ndarray],
+        cards: Dict[int, int],
+        scopes: List[FrozenSet[int]],
+        path: List[Tuple[int, int]],
+    ):
+        """
+        Create a new ContractionPlan. Plans are built by `plan_contraction`.
+
+        Parameters
+        ----------
+        inputs: list
+            The scope of each input table.
+        cards: dict
+            A mapping of each variable to its cardinality.
+        scopes: list
+            The variables left in each operand, inputs first, after elimination.
+        path: list
+            The pairs of operands contracted at each step.
+
+        """
+
+        self.inputs = inputs
+        self.cards = cards
+        self.scopes = scopes
+        self.path = path
+
+    @property
+    def sizes(self) -> List[int]:
+        """Get the size of the product table built at each step."""
+
+        return [
+            _size(self.scopes[i] | self.scopes[j], self.cards) for i, j in self.path
+        ]
+
+    @property
+    def cost(self) -> int:
+        """Get the total size of the product tables built by the plan."""
+
+        return int(sum(self.sizes))
+
+    @property
+    def largest(self) -> int:
+        """Get the size of the largest table built by the plan (inputs included)."""
+
+        inputs = [_size(frozenset(int(x) for x in s), self.cards) for s in self.inputs]
+        return int(max(inputs + self.sizes))
+
+    @property
+    def output(self) -> ndarray:
+        """Get the variables in the result of the plan."""
+
+        return np.asarray(sorted(self.scopes[-1]), dtype=np.int64)
+
+    def execute(
+        self, tables: Sequence[ndarray], maximise: bool = False
+    ) -> Tuple[ndarray, ndarray]:
+        """
+        Contract a set of batched tables following the plan.
+
+        Parameters
+        ----------
+        tables: list
+            The input tables, with a leading batch axis followed by one axis for each
+            variable in their scope (see `table_expand`).
+        maximise: bool, optional
+            If True, variables are maxed out, rather than summed out.
+
+        Returns
+        -------
+        out: tuple
+            The contracted (batched) table and its scope.
+
+        """
+
+        reduce = table_maximise if maximise else table_marginalise
+
+        operands = []
+        for table, scope, keep in zip(tables, self.inputs, self.scopes):
+            operands.append(reduce(table, np.asarray(scope), sorted(keep)))
+
+        for (i, j), keep in zip(self.path, self.scopes[len(self.inputs) :]):
+            table, scope = table_product(*operands[i], *operands[j])
+            operands.append(reduce(table, scope, sorted(keep)))
+
+            # operands are used once, so their tables can be released.
+            operands[i] = operands[j] = None
+
+        return operands[-1]
+
+    def __repr__(self):
+        return "{0}(steps={1}, cost={2}, largest={3})".format(
+            type(self).__name__, len(self.path), self.cost, self.largest
+        )
+
+
+def plan_contraction(
+    scopes: Sequence[ndarray],
+    cards: Dict[int, int],
+    output: Optional[Sequence[int]] = None,
+    exhaustive: int = 8,
+) -> ContractionPlan:
+    """
+    Search for a low cost order in which to contract a set of tables.
+
+    The cost of a plan is the total size of the product tables it builds. Sets of at
+    most 'exhaustive' tables are planned optimally, by dynamic programming over
+    subsets. Larger sets are planned greedily: at each step, the pair of operands
+    whose contraction shrinks the total size of the operands the most is chosen
+    [1].
+
+    Parameters
+    ----------
+    scopes: list
+        The scope of each table.
+    cards: dict
+        A mapping of each variable to its cardinality.
+    output: list, optional
+        The variables to keep in the result. By default, every variable is kept.
+    exhaustive: int, optional
+        The largest number of tables planned by an exhaustive search.
+
+    Returns
+    -------
+    out: ContractionPlan
+        The plan, which can be executed with `ContractionPlan.execute`.
+
+    References
+    ----------
+    [1] Opt_einsum - A Python package for optimizing contraction order for einsum-like
+        expressions, D. Smith, J. Gray
+
+    """
+
+    if len(scopes) == 0:
+        raise ValueError("Cannot plan the contraction of an empty set of tables.")
+
+    inputs = [np.asarray(scope) for scope in scopes]
+    leaves = [frozenset(int(x) for x in scope) for scope in inputs]
+
+    variables = frozenset().union(*leaves)
+    output = variables if output is None else frozenset(int(x) for x in output)
+    if not output <= variables:
+        raise ValueError(
+            "Cannot contract to variables not in any table: {0}.".format(
+                ", ".join(str(x) for x in sorted(output - variables))
+            )
+        )
+
+    # variables in a single table are eliminated before any contraction.
+    counts = Counter(x for leaf in leaves for x in leaf)
+    leaves = [
+        frozenset(x for x in leaf if x in output or counts[x] > 1) for leaf in leaves
+    ]
+
+    if len(leaves) <= exhaustive:
+        path, intermediates = _optimal_path(leaves, cards, output)
+    else:
+        path, intermediates = _greedy_path(leaves, cards, output)
+
+    return ContractionPlan(inputs, cards, leaves + intermediates, path)
+
+
+def _size(scope: FrozenSet[int], cards: Dict[int, int]) -> int:
+    """Get the number of entries in a table over a scope."""
+
+    return int(np.prod([cards[x] for x in scope], dtype=np.float64))
+
+
+def _greedy_path(
+    leaves: List[FrozenSet[int]], cards: Dict[int, int], output: FrozenSet[int]
+) -> Tuple[List[Tuple[int, int]], List[FrozenSet[int]]]:
+    """Repeatedly contract the pair of operands that removes the most entries."""
+
+    scopes = list(leaves)
+    remaining = set(range(len(scopes)))
+    counts = Counter(x for scope in scopes for x in scope)
+
+    path, intermediates = [], []
+    while len(remaining) > 1:
+        # only pairs sharing a variable are considered, until none are left.
+        holders: Dict[int, List[int]] = {}
+        for i in remaining:
+            for x in scopes[i]:
+                holders.setdefault(x, []).append(i)
+
+        pairs = {
+            (a, b) if a < b else (b, a)
+            for operands in holders.values()
+            for a in operands
+            for b in operands
+            if a != b
+        }
+        if len(pairs) == 0:
+            smallest = sorted(remaining, key=lambda i: (_size(scopes[i], cards), i))
+            pairs = {tuple(sorted(smallest[:2]))}
+
+        best = None
+        for i, j in pairs:
+            union = scopes[i] | scopes[j]
+            scope = frozenset(
+                x
+                for x in union
+                if x in output or counts[x] > (x in scopes[i]) + (x in scopes[j])
+            )
+            size = _size(scope, cards)
+            score = (
+                size - _size(scopes[i], cards) - _size(scopes[j], cards),
+                _size(union, cards),
+                i,
+                j,
+            )
+            if best is None or score < best[0]:
+                best = (score, (i, j), scope)
+
+        _, (i, j), scope = best
+        counts.subtract(scopes[i])
+        counts.subtract(scopes[j])
+        counts.update(scope)
+
+        remaining -= {i, j}
+        remaining.add(len(scopes))
+        scopes.append(scope)
+
+        path.append((i, j))
+        intermediates.append(scope)
+
+    return path, intermediates
+
+
+def _optimal_path(
+    leaves: List[FrozenSet[int]], cards: Dict[int, int], output: FrozenSet[int]
+) -> Tuple[List[Tuple[int, int]], List[FrozenSet[int]]]:
+    """Find the cheapest contraction order by dynamic programming over subsets."""
+
+    n = len(leaves)
+    full = (1 << n) - 1
+
+    def scope(mask: int) -> FrozenSet[int]:
+        inside = frozenset().union(*[leaves[i] for i in range(n) if mask >> i & 1])
+        outside = frozenset().union(*[leaves[i] for i in range(n) if not mask >> i & 1])
+        return frozenset(x for x in inside if x in output or x in outside)
+
+    scopes = {mask: scope(mask) for mask in range(1, full + 1)}
+
+    # the cheapest cost, and split, of contracting each subset into one operand.
+    best = {1 << i: (0, None) for i in range(n)}
+    for mask in sorted(range(1, full + 1), key=lambda x: bin(x).count("1")):
+        if mask in best:
+            continue
+
+        lowest = mask & -mask
+        sub = (mask - 1) & mask
+        while sub > 0:
+            # each split is visited once, with the lowest leaf on the left.
+            if sub & lowest:
+                rest = mask ^ sub
+                cost = (
+                    best[sub][0]
+                    + best[rest][0]
+                    + _size(scopes[sub] | scopes[rest], cards)
+                )
+                if mask not in best or cost < best[mask][0]:
+                    best[mask] = (cost, (sub, rest))
+            sub = (sub - 1) & mask
+
+    path: List[Tuple[int, int]] = []
+    intermediates: List[FrozenSet[int]] = []
+
+    def emit(mask: int) -> int:
+        if best[mask][1] is None:
+            return mask.bit_length() - 1
+
+        left, right = best[mask][1]
+        i, j = emit(left), emit(right)
+        path.append((i, j))
+        intermediates.append(scopes[mask])
+        return n + len(path) - 1
+
+    emit(full)
+
+    return path, intermediates
@@ -42,18 +42,25 @@ def _node_scope(idx: int, matrix: np.ndarray) -> np.ndarray:
 def get_elimination_ordering(
     matrix: np.ndarray, heuristic: callable = find_min_neighbours
 ):
-    """Compute the elimination ordering of a given graph in matrix-from."""
+    """
+    Compute the elimination ordering of a given graph in matrix-from.
+
+    Vertices left without neighbours (isolated vertices, or the last vertex in each
+    connected component) are eliminated as soon as they appear, so every vertex is
+    eliminated exactly once and has a scope, however many components the graph has.
+    """
+
+    matrix = np.array(matrix)
+    remaining = np.ones(matrix.shape[0], dtype=bool)
 
-    count = 0
     ordering = []
     scopes = []
-    while count < matrix.shape[0] - 1:
-        j = heuristic(matrix)
+    while remaining.any():
+        isolated = np.flatnonzero(remaining & (matrix.sum(axis=0) == 0))
+        j = int(isolated[0]) if len(isolated) > 0 else int(heuristic(matrix))
         scopes.append(_node_scope(j, matrix))
         matrix = eliminate_variable(j, matrix)
         ordering.append(j)
-        count += 1
-
-    ordering.append([x for x in range(matrix.shape[0]) if x not in ordering][0])
+        remaining[j] = False
 
     return ordering, scopes
@@ -0,0 +1,84 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+from typing import Tuple
+
+import numpy as np
+from numpy import ndarray
+
+
+def table_expand(table: ndarray, scope: ndarray, target: ndarray) -> ndarray:
+    """
+    Broadcast a batched table over 'scope' to the axes of a table over 'target'.
+
+    Tables are dense arrays with a leading batch axis, followed by one axis for each
+    variable in their scope (in scope order). Every variable in 'scope' must also be
+    in 'target'.
+    """
+
+    target = list(target)
+    positions = [target.index(x) for x in scope]
+
+    order = np.argsort(positions)
+    table = table.transpose(0, *[1 + i for i in order])
+
+    shape = [table.shape[0]] + [1] * len(target)
+    for i, position in enumerate(np.asarray(positions)[order]):
+        shape[1 + position] = table.shape[1 + i]
+
+    return table.reshape(shape)
+
+
+def table_product(
+    a: ndarray, a_scope: ndarray, b: ndarray, b_scope: ndarray
+) -> Tuple[ndarray, ndarray]:
+    """Compute the product of two batched tables, returning the table and scope."""
+
+    scope = np.union1d(a_scope, b_scope)
+    return table_expand(a, a_scope, scope) * table_expand(b, b_scope, scope), scope
+
+
+def table_marginalise(
+    table: ndarray, scope: ndarray, keep: ndarray
+) -> Tuple[ndarray, ndarray]:
+    """Sum out every variable not in 'keep' from a batched table."""
+
+    return _table_reduce(np.sum, table, scope, keep)
+
+
+def table_maximise(
+    table: ndarray, scope: ndarray, keep: ndarray
+) -> Tuple[ndarray, ndarray]:
+    """Max out every variable not in 'keep' from a batched table."""
+
+    return _table_reduce(np.max, table, scope, keep)
+
+
+def table_normalise(table: ndarray) -> Tuple[ndarray, ndarray]:
+    """
+    Normalise each table in a batch to sum to one, returning the table and the
+    normalising constants. Tables summing to zero are left unchanged.
+    """
+
+    axes = tuple(range(1, table.ndim))
+    z = table.sum(axis=axes, keepdims=True)
+    table = np.divide(table, z, out=np.zeros_like(table), where=z > 0)
+
+    return table, z.reshape(-1)
+
+
+def _table_reduce(
+    op: callable, table: ndarray, scope: ndarray, keep: ndarray
+) -> Tuple[ndarray, ndarray]:
+    """Apply a reduction over the axes of variables not in 'keep'."""
+
+    keep = np.isin(scope, keep)
+    axes = tuple(1 + i for i in np.flatnonzero(~keep))
+
+    if len(axes) == 0:
+        return table, np.asarray(scope)
+
+    return op(table, axis=axes), np.asarray(scope)[keep]
@@ -4,8 +4,6 @@ The MIT License
 Copyright (c) 2017-2020 Mark Douthwaite
 """
 
-import numpy as np
-
 from .arithmetic import factor_arithmetic
 
 
@@ -13,6 +11,9 @@ def factor_division(a, b):
     """
     Calculate the division of two factors. Currently aimed at discrete factors.
 
+    Division by zero is defined to be zero, as required when dividing out separator
+    potentials in the junction tree algorithm.
+
     Parameters
     ----------
     a: Factor-like
@@ -38,7 +39,13 @@ def factor_division(a, b):
     """
 
     return factor_arithmetic(
-        (a.scope, a.card, a.params, a.assignments),
-        (a.scope, a.card, a.params, a.assignments),
-        np.subtract,
+        (a.scope, a.cards, a.parameters, a.assignments),
+        (b.scope, b.cards, b.parameters, b.assignments),
+        safe_divide,
     )
+
+
+def safe_divide(x, y):
+    """Divide x by y, where any division by zero is defined to be zero."""
+
+    return x / y if y != 0 else 0.0
@@ -21,9 +21,9 @@ def factor_maximise(a, v):
     assignments = ap.cartesian_product(*[np.arange(n) for n in card])
     values = np.ones(len(assignments), dtype=np.float64) * -np.inf
 
-    avals = a.params
+    avals = a.parameters
 
-    for i in range(len(a.params)):
+    for i in range(len(avals)):
         j = assignment_to_index(index_to_assignment(i, a.cards)[f_map], card)
 
         values[j] = np.max([values[j], avals[i]])
@@ -11,7 +11,7 @@ def random_factor(
     max_card=3, max_scope=3, max_factor=10, min_factor=1, ftype=lambda x: x
 ):
     n = np.random.randint(1, max_scope + 1)
-    scope = apogee.legacy.random.urandint(min_factor, max_factor, size=(n,))
+    scope = np.random.choice(np.arange(min_factor, max_factor), size=n, replace=False)
     card = np.random.randint(2, max_card + 1, n)
     return ftype(scope, card, np.ones(np.product(card)))
 
@@ -8,6 +8,8 @@ from functools import reduce
 
 import numpy as np
 
+from apogee.core import ContractionPlan, plan_contraction
+
 
 class FactorSet(object):
     """Class representing a set of Factor objects."""
@@ -67,19 +69,59 @@ class FactorSet(object):
 
         return FactorSet(*self.get(*var))
 
-    def product(self) -> "Factor":
+    def plan(self, *var, exhaustive: int = 8) -> ContractionPlan:
+        """
+        Plan the contraction of the set down to one or more variables.
+
+        Parameters
+        ----------
+        var: int
+            The variables to keep. If none are given, every variable is eliminated.
+        exhaustive: int, optional
+            The largest number of factors planned by an exhaustive search, rather
+            than greedily (see `plan_contraction`).
+
+        """
+
+        cards = {}
+        for factor in self:
+            cards.update(zip(factor.scope.tolist(), factor.cards.tolist()))
+
+        return plan_contraction(
+            [factor.scope for factor in self],
+            cards,
+            output=var,
+            exhaustive=exhaustive,
+        )
+
+    def contract(self, *var, maximise: bool = False, **kwargs) -> "Factor":
+        """
+        Multiply the factors in the set, summing (or maxing) out every variable not in
+        'var', in the order given by `plan`.
+        """
+
+        plan = self.plan(*var, **kwargs)
+        table, scope = plan.execute(
+            [factor.parameters.reshape(1, *factor.cards) for factor in self],
+            maximise=maximise,
+        )
+
+        return type(self.factors[0])(scope, table.shape[1:], table.ravel())
+
+    def product(self, **kwargs) -> "Factor":
         """Compute the Joint Probability Distribution over the set."""
 
-        factor = self.factors[0]
-        for other in self.factors[1:]:
-            factor *= other
+        return self.contract(*self.vars, **kwargs)
+
+    def marginalise(self, *var, **kwargs) -> "Factor":
+        """Sum one or more variables out of the joint distribution of the set."""
 
-        return factor
+        return self.contract(*np.setdiff1d(self.vars, var), **kwargs)
 
-    def maximise(self, **kwargs) -> "Factor":
-        """Maximise the Joint Probability Distribution over the set."""
+    def maximise(self, *var, **kwargs) -> "Factor":
+        """Max one or more variables out of the joint distribution of the set."""
 
-        return self.product(**kwargs).maximise()
+        return self.contract(*np.setdiff1d(self.vars, var), maximise=True, **kwargs)
 
     def reduce(self, *args, **kwargs) -> "FactorSet":
         """Compute the reduced FactorSet (i.e. account for evidence)."""
@@ -146,15 +188,20 @@ class FactorSet(object):
 
     @property
     def adjacency_matrix(self) -> np.ndarray:
-        """Get the adjacency matrix of the FactorSet."""
-
-        adj = np.zeros((self.vars.shape[0], self.vars.shape[0]))
-        for i, f in enumerate(self.factors):
-            for vj in f.scope:
-                for vk in f.scope:
-                    j, k = vj, vk
-                    if j != k:
-                        adj[j, k] = 1.0
+        """
+        Get the adjacency matrix of the FactorSet.
+
+        Rows and columns are indexed by the position of each variable in `vars`, so
+        sets over any (not necessarily contiguous) variables are supported.
+        """
+
+        variables = self.vars
+        adj = np.zeros((variables.shape[0], variables.shape[0]))
+        for f in self.factors:
+            positions = np.searchsorted(variables, f.scope)
+            adj[np.ix_(positions, positions)] = 1.0
+
+        np.fill_diagonal(adj, 0.0)
         return adj
 
     def __len__(self):
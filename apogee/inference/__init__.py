@@ -5,5 +5,18 @@ Copyright (c) 2017-2020 Mark Douthwaite
 """
 
 from .junction_tree import JunctionTree
+from .cutset import CutsetConditioning
+from .loopy import LoopyBeliefPropagation
+from .sampling import ForwardSampler, LikelihoodWeighting
+from .gibbs import GibbsSampler
+from .batch import BatchExecutor
 
-__all__ = ["JunctionTree"]
+__all__ = [
+    "BatchExecutor",
+    "CutsetConditioning",
+    "ForwardSampler",
+    "GibbsSampler",
+    "JunctionTree",
+    "LikelihoodWeighting",
+    "LoopyBeliefPropagation",
+]
@@ -0,0 +1,81 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+from typing import Dict, List, Optional
+
+from apogee.utils.typing import FactorLike
+
+
+class Engine:
+    """
+    Observation handling shared by the engines that can stand in for a
+    `JunctionTree` in a model.
+
+    The engines implement the observation and marginal interface of `JunctionTree`,
+    so a model can use any of them. Subclasses implement `propagate` and `marginals`,
+    and `_update_evidence`, which is called whenever the evidence changes.
+    """
+
+    evidence: Dict[int, int]
+
+    def calibrate(self, variables: Optional[List[int]] = None) -> None:
+        """Accepted for compatibility with `JunctionTree`: results are read lazily."""
+
+    def update_observations(self, observations: List[List[int]]) -> None:
+        """
+        Update the observation state of the engine.
+
+        Parameters
+        ----------
+        observations: list
+            A list of observations of the form [[var: int, obs: int], ..., [...]].
+            An 'obs' of None retracts any evidence on variable 'var'.
+
+        """
+
+        evidence = dict(self.evidence)
+        for variable, state in observations or []:
+            if state is None:
+                evidence.pop(variable, None)
+            else:
+                evidence[variable] = int(state)
+
+        self.set_observations(evidence.items())
+
+    def set_observations(self, observations: List[List[int]]) -> None:
+        """
+        Replace the observation state of the engine.
+
+        Parameters
+        ----------
+        observations: list
+            A list of observations of the form [[var: int, obs: int], ..., [...]].
+            Any evidence on variables not included in 'observations' is retracted.
+
+        """
+
+        evidence = {int(variable): int(state) for variable, state in observations or []}
+        if evidence != self.evidence:
+            self._update_evidence(evidence)
+            self.evidence = evidence
+
+    def reset_observations(self) -> None:
+        """Reset the observation state of the engine."""
+
+        self.set_observations([])
+
+    def marginal(self, variable: int) -> FactorLike:
+        """Compute the marginal distribution for the given variable."""
+
+        return next(self.marginals(variable))
+
+    def close(self) -> None:
+        """Release any resources held by the engine."""
+
+    def _update_evidence(self, evidence: Dict[int, int]) -> None:
+        """Discard any results for the current evidence, before it is replaced."""
+
+        raise NotImplementedError
@@ -0,0 +1,151 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+from multiprocessing import Pool
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+import numpy as np
+
+from .junction_tree import JunctionTree
+
+try:
+    from multiprocessing import shared_memory
+
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+# the compiled tree (and the shared block backing it) attached by a worker process.
+_WORKER_STATE: Dict[str, Any] = {}
+
+
+class BatchExecutor:
+    """
+    Run batched junction tree inference on a pool of processes.
+
+    The clique potentials of a compiled tree are copied once into a block of shared
+    memory. Each worker process rebuilds the tree structure around zero-copy views of
+    that block when it starts, so workers neither recompile the model nor hold their
+    own copy of the potentials. Chunks of evidence are then fanned out to the pool,
+    and results are streamed back in the order the chunks were submitted.
+
+    Examples
+    --------
+    >>> with BatchExecutor(tree, processes=4) as executor:
+    ...     for marginals in executor.map(evidence):
+    ...         ...
+
+    """
+
+    def __init__(
+        self,
+        tree: JunctionTree,
+        processes: Optional[int] = None,
+        chunk_size: int = 10000,
+    ) -> None:
+        """
+        Create a new BatchExecutor.
+
+        Parameters
+        ----------
+        tree: JunctionTree
+            A compiled junction tree.
+        processes: int, optional
+            The number of worker processes. Defaults to the number of CPUs.
+        chunk_size: int, optional
+            The maximum number of rows sent to a worker at once.
+
+        """
+
+        if shared_memory is None:
+            raise RuntimeError("BatchExecutor requires Python 3.8 or greater.")
+
+        spec, potentials = _export(tree)
+
+        self.chunk_size = chunk_size
+        self._memory = shared_memory.SharedMemory(create=True, size=potentials.nbytes)
+        np.ndarray(potentials.shape, potentials.dtype, buffer=self._memory.buf)[
+            :
+        ] = potentials
+
+        self._pool = Pool(
+            processes, initializer=_attach, initargs=(spec, self._memory.name)
+        )
+
+    def map(
+        self, evidence: Dict[int, np.ndarray], variables: Optional[List[int]] = None
+    ) -> Generator[Dict[int, np.ndarray], None, None]:
+        """
+        Compute marginals for a batch of evidence, one chunk at a time.
+
+        Parameters
+        ----------
+        evidence: dict
+            A mapping of variables to integer arrays of observed states, as accepted
+            by `JunctionTree.propagate_batch`.
+        variables: list, optional
+            The variables to compute marginals for. Defaults to every variable.
+
+        Yields
+        ------
+        out: dict
+            The marginals for each chunk of rows, in order.
+
+        """
+
+        rows = len(next(iter(evidence.values()))) if len(evidence) > 0 else 0
+        chunks = (
+            ({k: v[i : i + self.chunk_size] for k, v in evidence.items()}, variables)
+            for i in range(0, rows, self.chunk_size)
+        )
+
+        for marginals in self._pool.imap(_propagate, chunks):
+            yield marginals
+
+    def close(self) -> None:
+        """Stop the worker pool and release the shared potentials."""
+
+        self._pool.close()
+        self._pool.join()
+        self._memory.close()
+        self._memory.unlink()
+
+    def __enter__(self) -> "BatchExecutor":
+        return self
+
+    def __exit__(self, *args: Optional[Any]) -> None:
+        self.close()
+
+
+def _export(tree: JunctionTree) -> Tuple[dict, np.ndarray]:
+    """Split a compiled tree into a picklable structure and a flat potential array."""
+
+    spec = tree.to_arrays()
+    potentials = spec.pop("potentials")
+    spec["propagation"] = tree.propagation
+
+    return spec, potentials
+
+
+def _attach(spec: dict, name: str) -> None:
+    """Rebuild a compiled tree in a worker around views of the shared potentials."""
+
+    memory = shared_memory.SharedMemory(name=name)
+    size = int(spec["potential_offsets"][-1])
+    potentials = np.ndarray((size,), dtype=np.float32, buffer=memory.buf)
+
+    tree = JunctionTree.from_arrays(dict(spec, potentials=potentials))
+
+    _WORKER_STATE.update(tree=tree, memory=memory)
+
+
+def _propagate(
+    chunk: Tuple[Dict[int, np.ndarray], Optional[List[int]]]
+) -> Dict[int, np.ndarray]:
+    """Propagate a chunk of evidence through the worker's tree."""
+
+    evidence, variables = chunk
+    return _WORKER_STATE["tree"].propagate_batch(evidence, variables=variables)
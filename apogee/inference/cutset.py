@@ -0,0 +1,382 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+from multiprocessing import Pool
+from typing import Any, Dict, List, Optional, Tuple
+
+import networkx as nx
+import numpy as np
+
+from apogee.core import table_expand
+from apogee.factors import DiscreteFactor, FactorSet
+from apogee.utils.typing import FactorLike, FactorSetLike
+
+from .base import Engine
+from .junction_tree import JunctionTree, SHAFER_SHENOY
+
+
+# the engine attached by a worker process.
+_WORKER_STATE: Dict[str, Any] = {}
+
+
+class CutsetConditioning(Engine):
+    """
+    Exact inference within a memory budget by cutset conditioning.
+
+    A set of variables (the cutset) is chosen so that, once every variable in it is
+    fixed, the junction tree of the remaining model fits the budget. Inference is
+    then run once for each instantiation of the cutset, on a junction tree over the
+    remaining variables, and the results are combined: each instantiation 'c' gives
+    P(v | c, e) and P(c, e), and P(v | e) is their weighted average [1].
+
+    Only the reduced tree is compiled, so memory is bounded by the budget, while
+    time grows with the number of instantiations. Instantiations are independent,
+    and can be spread over a pool of processes.
+
+    References
+    ----------
+    [1] Probabilistic Reasoning in Intelligent Systems, J. Pearl
+
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        processes: Optional[int] = None,
+        batch_size: int = 256,
+        propagation: str = SHAFER_SHENOY,
+    ):
+        """
+        Create a new CutsetConditioning instance.
+
+        Parameters
+        ----------
+        max_bytes: int, optional
+            A ceiling on the estimated size of the reduced junction tree's tables
+            (see `JunctionTree.complexity`). Variables are added to the cutset until
+            the tree fits. By default, a loop cutset is chosen, leaving a tree of
+            single factors.
+        processes: int, optional
+            If set, instantiations are spread over a pool of this many processes.
+            Call `close` to stop the pool.
+        batch_size: int, optional
+            The number of instantiations propagated at once. Peak memory is roughly
+            this many times the size of the reduced tree.
+        propagation: str, optional
+            The propagation scheme of the reduced junction tree.
+
+        """
+
+        self.max_bytes = max_bytes
+        self.processes = processes
+        self.batch_size = batch_size
+        self.propagation = propagation
+        self.evidence: Dict[int, int] = {}
+        self.cutset: List[int] = []
+
+        self._factors: List[FactorLike] = []
+        self._cards: Dict[int, int] = {}
+        self._tree: Optional[JunctionTree] = None
+        self._scopes: List[np.ndarray] = []
+        self._hosts: List[Optional[int]] = []
+        self._marginals: Optional[Dict[int, np.ndarray]] = None
+        self._log_evidence = 0.0
+        self._pool: Optional[Pool] = None
+
+    def initialise(self, factor_set: FactorSetLike) -> "CutsetConditioning":
+        """Choose a cutset and compile the reduced tree for a set of factors."""
+
+        self.close()
+
+        self._factors = list(factor_set.factors)
+        self._cards = {}
+        for factor in self._factors:
+            for variable, card in zip(factor.scope, factor.cards):
+                self._cards[int(variable)] = int(card)
+
+        self.cutset = self._choose_cutset()
+
+        # every instantiation gives a tree of the same structure, so one is compiled.
+        assignment = {variable: 0 for variable in self.cutset}
+        reduced = [self._condition(factor, assignment) for factor in self._factors]
+        self._tree = JunctionTree.from_factors(
+            FactorSet(*[x for x in reduced if len(x.scope) > 0]),
+            propagation=self.propagation,
+        )
+        self._scopes = [np.asarray(factor.scope) for factor in self._tree.factors]
+
+        # each factor is multiplied into the first clique containing it.
+        self._hosts = []
+        for factor in reduced:
+            hosts = [
+                node
+                for node, scope in enumerate(self._scopes)
+                if np.all(np.isin(factor.scope, scope))
+            ]
+            self._hosts.append(hosts[0] if len(factor.scope) > 0 else None)
+
+        self.evidence = {}
+        self._marginals = None
+
+        return self
+
+    def _choose_cutset(self) -> List[int]:
+        """Greedily condition on the most connected variable on a cycle."""
+
+        graph = nx.Graph()
+        graph.add_nodes_from(self._cards)
+        for factor in self._factors:
+            scope = [int(x) for x in factor.scope]
+            graph.add_edges_from((a, b) for a in scope for b in scope if a < b)
+
+        cutset = []
+        while True:
+            if self.max_bytes is not None:
+                assignment = {variable: 0 for variable in cutset}
+                reduced = [self._condition(x, assignment) for x in self._factors]
+                required = JunctionTree.complexity(
+                    FactorSet(*[x for x in reduced if len(x.scope) > 0])
+                )["table_bytes"]
+
+                if required <= self.max_bytes:
+                    return cutset
+
+            # variables outside the 2-core are on no cycle. Once none are left, the
+            # model is a forest, and only a budget requires fixing any more.
+            core = nx.k_core(graph, 2)
+            if core.number_of_nodes() == 0:
+                if self.max_bytes is None:
+                    return cutset
+
+                core = graph.subgraph([x for x in graph if graph.degree(x) > 0])
+                if core.number_of_nodes() == 0:
+                    raise ValueError(
+                        "Cannot condition the model to within {0} bytes.".format(
+                            self.max_bytes
+                        )
+                    )
+
+            variable = max(
+                core.nodes, key=lambda x: (core.degree(x), -self._cards[x], -x)
+            )
+            graph.remove_node(variable)
+            cutset.append(int(variable))
+
+    @staticmethod
+    def _condition(factor: FactorLike, assignment: Dict[int, int]) -> FactorLike:
+        """Fix variables in a factor, removing them from its scope."""
+
+        table = factor.parameters.reshape(*factor.cards)
+        keep = np.asarray([int(x) not in assignment for x in factor.scope], dtype=bool)
+        index = tuple(
+            slice(None) if k else assignment[int(x)] for x, k in zip(factor.scope, keep)
+        )
+
+        return DiscreteFactor(
+            np.asarray(factor.scope)[keep],
+            np.asarray(factor.cards)[keep],
+            np.ravel(table[index]),
+        )
+
+    def _instantiations(self) -> np.ndarray:
+        """Enumerate the instantiations of the cutset consistent with the evidence."""
+
+        if len(self.cutset) == 0:
+            return np.zeros((1, 0), dtype=np.int64)
+
+        states = [
+            [self.evidence[x]] if x in self.evidence else range(self._cards[x])
+            for x in self.cutset
+        ]
+        grid = np.meshgrid(*[np.asarray(x) for x in states], indexing="ij")
+
+        return np.stack([x.ravel() for x in grid], axis=-1).reshape(
+            -1, len(self.cutset)
+        )
+
+    def solve(
+        self, instantiations: np.ndarray, evidence: Dict[int, int]
+    ) -> Tuple[np.ndarray, Dict[int, np.ndarray]]:
+        """
+        Run inference for a batch of instantiations of the cutset at once.
+
+        The potentials of the reduced tree under each instantiation are stacked on a
+        leading batch axis, so a batch is propagated in a single pass (see
+        `JunctionTree.propagate_batch`).
+
+        Parameters
+        ----------
+        instantiations: ndarray
+            An array of shape (rows, len(cutset)) of cutset states.
+        evidence: dict
+            A mapping of observed variables to their states.
+
+        Returns
+        -------
+        out: tuple
+            The log probability of each instantiation and the evidence, log P(c, e),
+            and the marginals P(v | c, e) of each variable not in the cutset, each of
+            shape (rows, cardinality).
+
+        """
+
+        rows = len(instantiations)
+        positions = {variable: i for i, variable in enumerate(self.cutset)}
+
+        potentials = [
+            np.ones((rows, *[self._cards[int(x)] for x in scope]))
+            for scope in self._scopes
+        ]
+
+        log_weights = np.zeros(rows)
+        with np.errstate(divide="ignore"):
+            for factor, node in zip(self._factors, self._hosts):
+                table, scope = self._condition_batch(factor, instantiations, positions)
+                if node is None:
+                    log_weights += np.log(table)
+                else:
+                    potentials[node] = potentials[node] * table_expand(
+                        table, scope, self._scopes[node]
+                    )
+
+        evidence = {
+            variable: np.full(rows, state)
+            for variable, state in evidence.items()
+            if variable not in positions
+        }
+        variables = [x for x in sorted(self._cards) if x not in positions]
+
+        log_weights += self._tree.log_evidence_batch(evidence, potentials=potentials)
+        marginals = self._tree.propagate_batch(
+            evidence, variables=variables, potentials=potentials
+        )
+
+        return log_weights, marginals
+
+    @staticmethod
+    def _condition_batch(
+        factor: FactorLike, instantiations: np.ndarray, positions: Dict[int, int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Fix the cutset variables in a factor under each of a batch of states."""
+
+        scope = [int(x) for x in factor.scope]
+        fixed = [axis for axis, x in enumerate(scope) if x in positions]
+        free = [axis for axis, x in enumerate(scope) if x not in positions]
+
+        table = factor.parameters.reshape(*factor.cards)
+        if len(fixed) == 0:
+            return table[None], np.asarray(scope)
+
+        # move the fixed axes to the front, so that indexing them leaves a batch axis.
+        table = np.moveaxis(table, fixed, range(len(fixed)))
+        table = table[tuple(instantiations[:, positions[scope[x]]] for x in fixed)]
+
+        return table, np.asarray(scope)[free]
+
+    def propagate(self, variables: Optional[List[int]] = None) -> None:
+        """Run inference for every instantiation of the cutset, if required."""
+
+        if self._marginals is not None:
+            return
+
+        instantiations = self._instantiations()
+        batches = [
+            instantiations[i : i + self.batch_size]
+            for i in range(0, len(instantiations), self.batch_size)
+        ]
+
+        if self.processes is None:
+            results = [self.solve(x, self.evidence) for x in batches]
+        else:
+            if self._pool is None:
+                self._pool = Pool(self.processes, initializer=_attach, initargs=(self,))
+            results = self._pool.map(_solve, [(x, self.evidence) for x in batches])
+
+        log_weights = np.concatenate([log_weights for log_weights, _ in results])
+        shift = log_weights.max()
+        shift = shift if np.isfinite(shift) else 0.0
+
+        weights = np.exp(log_weights - shift)
+        total = weights.sum()
+        self._log_evidence = float(shift + np.log(total)) if total > 0 else -np.inf
+
+        marginals = {}
+        for variable in results[0][1]:
+            # instantiations with no weight may have undefined marginals.
+            rows = np.concatenate([result[variable] for _, result in results])
+            marginals[variable] = weights[weights > 0] @ rows[weights > 0]
+
+        for i, variable in enumerate(self.cutset):
+            marginals[variable] = np.bincount(
+                instantiations[:, i], weights=weights, minlength=self._cards[variable]
+            )
+
+        self._marginals = {
+            variable: marginal / total if total > 0 else marginal
+            for variable, marginal in marginals.items()
+        }
+
+    def _update_evidence(self, evidence: Dict[int, int]) -> None:
+        """Discard the marginals computed for the current evidence."""
+
+        self._marginals = None
+
+    def marginals(self, *variables: Tuple[int]) -> FactorLike:
+        """Compute the marginal distributions for a collection of variables."""
+
+        self.propagate()
+
+        for variable in variables:
+            marginal = self._marginals[variable]
+            yield DiscreteFactor(
+                np.asarray([variable]), np.asarray([len(marginal)]), marginal
+            )
+
+    def log_evidence(self) -> float:
+        """Compute the log probability of the evidence, log P(e)."""
+
+        self.propagate()
+        return self._log_evidence
+
+    def close(self) -> None:
+        """Stop the worker pool, if one is running."""
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __getstate__(self) -> dict:
+        # the pool cannot be sent to (and is not needed by) worker processes.
+        return dict(self.__dict__, _pool=None)
+
+    def __contains__(self, variable: int) -> bool:
+        """Check if a variable is in the scope of the engine."""
+
+        return variable in self._cards
+
+    @classmethod
+    def from_factors(
+        cls, factor_set: FactorSetLike, **kwargs: Optional[Any]
+    ) -> "CutsetConditioning":
+        """Create an engine from a provided FactorSet object."""
+
+        return cls(**kwargs).initialise(factor_set)
+
+
+def _attach(engine: CutsetConditioning) -> None:
+    """Keep a copy of the engine in a worker process."""
+
+    _WORKER_STATE.update(engine=engine)
+
+
+def _solve(
+    task: Tuple[np.ndarray, Dict[int, int]],
+) -> Tuple[np.ndarray, Dict[int, np.ndarray]]:
+    """Run inference for a batch of instantiations in a worker process."""
+
+    instantiations, evidence = task
+    return _WORKER_STATE["engine"].solve(instantiations, evidence)
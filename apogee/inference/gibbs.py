@@ -0,0 +1,387 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+from multiprocessing import Pool
+from typing import Any, Dict, List, Optional, Tuple
+
+import networkx as nx
+import numpy as np
+
+from apogee.factors import DiscreteFactor
+from apogee.utils.typing import FactorLike, FactorSetLike
+
+from .base import Engine
+
+
+class GibbsSampler(Engine):
+    """
+    Approximate inference by blocked Gibbs sampling.
+
+    Each variable is resampled from its conditional distribution given the rest of
+    the model, which depends only on the factors in its Markov blanket. Variables
+    that share no factor are conditionally independent, so the interaction graph is
+    coloured and each colour is resampled as a single block: one vectorised update
+    draws every variable in the block, in every chain.
+
+    Many chains are run at once as a batch axis of the sampler state. Chains can also
+    be split into groups and run on a pool of processes. Marginals are estimated
+    from the retained samples of every chain, and `diagnostics` reports the effective
+    sample size and (split) R-hat [1] of each estimate, so the number of samples can
+    be traded against accuracy knowingly.
+
+    Unlike likelihood weighting, evidence is clamped rather than weighted, so the
+    sampler does not degenerate under unlikely evidence. However, chains mix slowly
+    on models with near-deterministic factors, and may not mix at all where factors
+    are deterministic (an R-hat of infinity indicates chains that never moved).
+
+    References
+    ----------
+    [1] Bayesian Data Analysis (3rd ed.), A. Gelman et al.
+
+    """
+
+    def __init__(
+        self,
+        chains: int = 64,
+        samples: int = 500,
+        burn_in: int = 100,
+        thin: int = 1,
+        processes: Optional[int] = None,
+        random_state: Optional[int] = None,
+    ):
+        """
+        Create a new GibbsSampler instance.
+
+        Parameters
+        ----------
+        chains: int, optional
+            The number of chains.
+        samples: int, optional
+            The number of samples retained from each chain.
+        burn_in: int, optional
+            The number of sweeps discarded at the start of each chain.
+        thin: int, optional
+            The number of sweeps per retained sample.
+        processes: int, optional
+            If set, chains are split into this many groups, each run on a pool of
+            processes. By default, every chain is run in this process.
+        random_state: int, optional
+            A seed for the random number generator.
+
+        """
+
+        self.chains = chains
+        self.samples = samples
+        self.burn_in = burn_in
+        self.thin = thin
+        self.processes = processes
+        self.evidence: Dict[int, int] = {}
+        self._random = np.random.RandomState(random_state)
+
+        # variables, indexed by position.
+        self._variables = np.zeros(0, dtype=np.int64)
+        self._cards = np.zeros(0, dtype=np.int64)
+        self._positions: Dict[int, int] = {}
+
+        # log factor tables, concatenated, and the precomputed updates of each block.
+        self._tables = np.zeros(0)
+        self._blocks: List[Dict[str, np.ndarray]] = []
+
+        # retained samples, of shape (samples, chains, variables).
+        self._trace: Optional[np.ndarray] = None
+
+    def initialise(self, factor_set: FactorSetLike) -> "GibbsSampler":
+        """Build the blocks and conditionals for a set of factors."""
+
+        factors = list(factor_set.factors)
+
+        cards = {}
+        for factor in factors:
+            for variable, card in zip(factor.scope, factor.cards):
+                cards[int(variable)] = int(card)
+
+        self._variables = np.asarray(sorted(cards), dtype=np.int64)
+        self._cards = np.asarray([cards[x] for x in self._variables], dtype=np.int64)
+        self._positions = {int(x): i for i, x in enumerate(self._variables)}
+
+        offsets = np.cumsum([0] + [len(factor.parameters) for factor in factors])
+        with np.errstate(divide="ignore"):
+            self._tables = np.log(
+                np.concatenate([factor.parameters for factor in factors])
+            ).astype(np.float64)
+
+        graph = nx.Graph()
+        graph.add_nodes_from(range(len(self._variables)))
+        for factor in factors:
+            scope = [self._positions[int(x)] for x in factor.scope]
+            graph.add_edges_from((a, b) for a in scope for b in scope if a < b)
+
+        colours: Dict[int, List[int]] = {}
+        for position, colour in nx.greedy_color(
+            graph, strategy="largest_first"
+        ).items():
+            colours.setdefault(colour, []).append(position)
+
+        index = {id(factor): i for i, factor in enumerate(factors)}
+        self._blocks = [
+            self._block(sorted(positions), factor_set, index, offsets)
+            for _, positions in sorted(colours.items())
+        ]
+
+        self.evidence = {}
+        self._trace = None
+
+        return self
+
+    def _block(
+        self,
+        positions: List[int],
+        factor_set: FactorSetLike,
+        index: Dict[int, int],
+        offsets: np.ndarray,
+    ) -> Dict[str, np.ndarray]:
+        """Precompute the table lookups for the conditionals of a block."""
+
+        width = int(self._cards.max())
+        pairs = []
+        for target, position in enumerate(positions):
+            variable = self._variables[position]
+            for factor in factor_set.blanket(variable).factors:
+                strides = np.cumprod(np.r_[1, factor.cards[::-1]])[-2::-1]
+                scope = [self._positions[int(x)] for x in factor.scope]
+                axis = scope.index(position)
+                pairs.append(
+                    (
+                        target,
+                        offsets[index[id(factor)]],
+                        strides[axis],
+                        [x for i, x in enumerate(scope) if i != axis],
+                        [x for i, x in enumerate(strides) if i != axis],
+                    )
+                )
+
+        depth = max([len(pair[3]) for pair in pairs] + [1])
+        others = np.zeros((len(pairs), depth), dtype=np.int64)
+        strides = np.zeros((len(pairs), depth), dtype=np.int64)
+        for i, (_, _, _, scope, stride) in enumerate(pairs):
+            others[i, : len(scope)] = scope
+            strides[i, : len(stride)] = stride
+
+        targets = np.asarray([pair[0] for pair in pairs], dtype=np.int64)
+        cards = self._cards[positions]
+
+        return {
+            "positions": np.asarray(positions, dtype=np.int64),
+            "starts": np.searchsorted(targets, np.arange(len(positions))),
+            "offsets": np.asarray([pair[1] for pair in pairs], dtype=np.int64),
+            "strides": np.asarray([pair[2] for pair in pairs], dtype=np.int64),
+            "others": others,
+            "other_strides": strides,
+            "mask": np.where(np.arange(width)[None, :] < cards[:, None], 0.0, -np.inf),
+        }
+
+    def run(
+        self, chains: int, random_state: Optional[np.random.RandomState] = None
+    ) -> np.ndarray:
+        """
+        Run a number of chains with the current evidence.
+
+        Returns
+        -------
+        out: ndarray
+            The retained samples, of shape (samples, chains, variables).
+
+        """
+
+        random_state = random_state or np.random
+
+        observed = np.asarray(
+            [self._positions[x] for x in self.evidence], dtype=np.int64
+        )
+        states = np.asarray(list(self.evidence.values()), dtype=np.int64)
+
+        state = np.floor(
+            random_state.random_sample((chains, len(self._cards))) * self._cards
+        ).astype(np.int64)
+        state[:, observed] = states
+
+        trace = np.zeros((self.samples, chains, len(self._cards)), dtype=np.int16)
+        for sweep in range(self.burn_in + self.samples * self.thin):
+            for block in self._blocks:
+                self._update(block, state, random_state)
+                state[:, observed] = states
+
+            kept = sweep - self.burn_in
+            if kept >= 0 and kept % self.thin == 0:
+                trace[kept // self.thin] = state
+
+        return trace
+
+    def _update(
+        self,
+        block: Dict[str, np.ndarray],
+        state: np.ndarray,
+        random_state: np.random.RandomState,
+    ) -> None:
+        """Resample every variable in a block, in every chain, from its conditional."""
+
+        mask = block["mask"]
+        states = np.arange(mask.shape[1])
+
+        # the index of the first state of the target in each factor, in each chain.
+        base = block["offsets"][:, None] + np.sum(
+            block["other_strides"][:, :, None] * state.T[block["others"]], axis=1
+        )
+        lookup = base[:, :, None] + block["strides"][:, None, None] * states
+        values = self._tables[np.minimum(lookup, len(self._tables) - 1)]
+
+        logits = np.add.reduceat(values, block["starts"], axis=0) + mask[:, None, :]
+
+        # chains in an impossible state (possible before burn-in) are moved uniformly.
+        stuck = ~np.isfinite(logits.max(axis=2))
+        logits[stuck] = np.broadcast_to(mask[:, None, :], logits.shape)[stuck]
+
+        noise = -np.log(-np.log(random_state.random_sample(logits.shape)))
+        state[:, block["positions"]] = np.argmax(logits + noise, axis=2).T
+
+    def propagate(self, variables: Optional[List[int]] = None) -> None:
+        """Run the chains, if they have not been run for the current evidence."""
+
+        if self._trace is not None:
+            return
+
+        if self.processes is None:
+            self._trace = self.run(self.chains, random_state=self._random)
+            return
+
+        groups = np.array_split(np.arange(self.chains), self.processes)
+        seeds = self._random.randint(2**31 - 1, size=len(groups))
+        with Pool(self.processes) as pool:
+            traces = pool.map(
+                _run, [(self, len(group), seed) for group, seed in zip(groups, seeds)]
+            )
+
+        self._trace = np.concatenate(traces, axis=1)
+
+    def _update_evidence(self, evidence: Dict[int, int]) -> None:
+        """Discard the samples drawn for the current evidence."""
+
+        self._trace = None
+
+    def marginals(self, *variables: Tuple[int]) -> FactorLike:
+        """Estimate the marginal distributions for a collection of variables."""
+
+        self.propagate()
+
+        for variable in variables:
+            position = self._positions[variable]
+            card = int(self._cards[position])
+            counts = np.bincount(self._trace[:, :, position].ravel(), minlength=card)
+
+            yield DiscreteFactor(
+                np.asarray([variable]), np.asarray([card]), counts / counts.sum()
+            )
+
+    def diagnostics(self, *variables: Tuple[int]) -> Dict[int, Dict[str, float]]:
+        """
+        Get convergence diagnostics for the marginals of some (or all) variables.
+
+        Each state of a variable is treated as an indicator, and the smallest
+        effective sample size and largest split R-hat over its states are reported.
+        Values of R-hat much above 1 (conventionally, 1.01) indicate that the chains
+        have not mixed.
+
+        Returns
+        -------
+        out: dict
+            A mapping of each variable to its 'ess' and 'r_hat'.
+
+        """
+
+        self.propagate()
+
+        variables = variables or [int(x) for x in self._variables]
+
+        report = {}
+        for variable in variables:
+            position = self._positions[variable]
+            trace = self._trace[:, :, position]
+
+            ess, r_hat = [], []
+            for state in range(int(self._cards[position])):
+                a, b = _diagnostics((trace == state).astype(np.float64))
+                ess.append(a)
+                r_hat.append(b)
+
+            report[variable] = {"ess": min(ess), "r_hat": max(r_hat)}
+
+        return report
+
+    def __contains__(self, variable: int) -> bool:
+        """Check if a variable is in the scope of the sampler."""
+
+        return variable in self._positions
+
+    @classmethod
+    def from_factors(
+        cls, factor_set: FactorSetLike, **kwargs: Optional[Any]
+    ) -> "GibbsSampler":
+        """Create a sampler from a provided FactorSet object."""
+
+        return cls(**kwargs).initialise(factor_set)
+
+
+def _run(task: Tuple[GibbsSampler, int, int]) -> np.ndarray:
+    """Run a group of chains in a worker process."""
+
+    sampler, chains, seed = task
+    return sampler.run(chains, random_state=np.random.RandomState(seed))
+
+
+def _diagnostics(trace: np.ndarray) -> Tuple[float, float]:
+    """
+    Compute the effective sample size and split R-hat of a trace of shape (samples,
+    chains), as described in [1].
+    """
+
+    # each chain is split in half, so that chains that drift are caught too.
+    half = trace.shape[0] // 2
+    if half < 2:
+        return float(trace.size), float("nan")
+
+    chains = np.concatenate([trace[:half], trace[-half:]], axis=1)
+    n, m = chains.shape
+
+    means = chains.mean(axis=0)
+    within = chains.var(axis=0, ddof=1).mean()
+    between = n * means.var(ddof=1)
+    variance = (n - 1) / n * within + between / n
+
+    if variance <= 0:
+        # the indicator is constant: every chain agrees exactly.
+        return float(n * m), 1.0
+
+    r_hat = float(np.sqrt(variance / within)) if within > 0 else float("inf")
+
+    # autocovariances of each chain, via the FFT.
+    centred = chains - means
+    size = 1 << int(np.ceil(np.log2(2 * n)))
+    spectrum = np.fft.rfft(centred, n=size, axis=0)
+    autocovariance = np.fft.irfft(spectrum * np.conj(spectrum), n=size, axis=0)[:n]
+    autocovariance = autocovariance.mean(axis=1) / n
+
+    rho = 1.0 - (within - autocovariance) / variance
+    rho[0] = 1.0
+
+    # sum autocorrelations in pairs while the pairs remain positive (Geyer).
+    total = 0.0
+    for t in range(0, n - 1, 2):
+        pair = rho[t] + rho[t + 1]
+        if pair < 0:
+            break
+        total += pair
+
+    return float(n * m / max(2.0 * total - 1.0, 1.0 / np.log10(n * m))), r_hat
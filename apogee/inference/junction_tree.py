@@ -4,15 +4,43 @@ The MIT License
 Copyright (c) 2017-2020 Mark Douthwaite
 """
 
-from typing import Tuple, List, Generator
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappop, heappush
+from itertools import combinations, count
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Text,
+    Tuple,
+)
 
 import networkx as nx
 import numpy as np
 
-from apogee.core import get_elimination_ordering, union1d, difference1d
+from apogee.core import (
+    get_elimination_ordering,
+    union1d,
+    difference1d,
+    subset,
+    table_expand,
+    table_marginalise,
+    table_normalise,
+)
+from apogee import io
+from apogee.factors import DiscreteFactor, FactorSet
 from apogee.utils.typing import FactorLike, FactorSetLike
 
 
+SHAFER_SHENOY = "shafer-shenoy"
+HUGIN = "hugin"
+
+
 class JunctionTree:
     """
     An implementation of the Junction Tree algorithm.
@@ -29,203 +57,1546 @@ class JunctionTree:
     [1] Probabilistic Graphical Models, Principles and Techniques,
         D. Koller, N. Friedman
     [2] https://en.wikipedia.org/wiki/Junction_tree_algorithm
+    [3] Bayesian Networks and Decision Graphs, F. Jensen, T. Nielsen
+
+    Two propagation schemes are supported. The default 'shafer-shenoy' scheme stores
+    a message in each direction on every edge, and can reuse messages that are not
+    affected by changes in evidence. The 'hugin' scheme [3] stores a potential on
+    each separator and absorbs each clique once per direction by multiplying in the
+    ratio of the new and old separator potentials, which avoids re-multiplying the
+    incoming messages of high-degree cliques.
+
+    The compiled tree is stored as flat arrays: each clique has a parent index (or -1
+    at the root of a tree), children are stored as ranges of a single index array,
+    and every edge is identified by its child clique, which indexes its separator,
+    its HUGIN potential and its two message slots. Use `to_networkx` to export the
+    tree as a graph.
+
+    Models built from independent sub-networks compile to a forest with one tree per
+    connected component. Propagation can be restricted to the trees hosting a set of
+    query variables, and the calibrated state of every other tree is left untouched,
+    so their prior (or previously computed) marginals are reused by later queries.
 
     # Todo: Complete an optimisation pass over this. Lots to tighten up.
 
     """
 
-    def __init__(self):
-        self.graph = nx.Graph()
+    def __init__(self, propagation: str = SHAFER_SHENOY, workers: Optional[int] = None):
+        """
+        Create a new JunctionTree instance.
 
-    def add(
-        self, variable: int, factor: FactorLike, tau: List[int], neighbours: List[int]
-    ) -> None:
-        """Add a variable to the tree."""
+        Parameters
+        ----------
+        propagation: str, optional
+            The propagation scheme, either 'shafer-shenoy' (the default) or 'hugin'.
+        workers: int, optional
+            If set, independent messages are sent concurrently on a pool of this many
+            threads, level by level. This helps on wide trees with large cliques, where
+            NumPy releases the GIL. HUGIN absorption is always sequential.
+
+        """
+
+        if propagation not in (SHAFER_SHENOY, HUGIN):
+            raise ValueError("Unknown propagation scheme '{0}'.".format(propagation))
+
+        self.propagation = propagation
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.evidence: Dict[int, int] = {}
+        self._hosts: Dict[int, int] = {}
+        self._marginal_hosts: Dict[int, Tuple[int, ...]] = {}
+        self._priors: Dict[int, Dict[int, np.ndarray]] = {}
 
-        self.graph.add_node(variable, factor=factor, tau=tau)
-        for node, attrs in self.graph.nodes.items():
-            if node != variable and attrs["tau"] in neighbours:
-                messages = {(variable, node): None, (node, variable): None}
-                self.graph.add_edge(variable, node, messages=messages)
+        # cliques, indexed by node.
+        self._factors: List[FactorLike] = []
+        self._cached: List[FactorLike] = []
+        self._beliefs: List[Optional[FactorLike]] = []
+        self._scales = np.zeros(0)
+        self._links: List[Tuple[int, int]] = []
+
+        # structure, built from the links between cliques by `_index_structure`.
+        self._parents = np.zeros(0, dtype=np.int64)
+        self._children = np.zeros(0, dtype=np.int64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._components = np.zeros(0, dtype=np.int64)
+        self._trees: Dict[int, List[Tuple[int, int]]] = {}
+        self._adjacency: List[List[int]] = []
+        self._parent_of: List[int] = []
+        self._depth_of: List[int] = []
+
+        # edges, indexed by child node. Message slot 'c' holds the message from 'c' to
+        # its parent, and slot 'n + c' the message from the parent to 'c'.
+        self._separators: List[Optional[np.ndarray]] = []
+        self._potentials: List[Optional[FactorLike]] = []
+        self._messages: List[Optional[FactorLike]] = []
+        self._message_scales = np.zeros(0)
+
+    def add(self, node: int, factor: FactorLike) -> None:
+        """Add a clique to the tree. Cliques must be numbered in the order added."""
+
+        if node != len(self._factors):
+            raise ValueError(
+                "Expected clique {0}, but got clique {1}.".format(
+                    len(self._factors), node
+                )
+            )
+
+        self._factors.append(factor)
+        self._cached.append(factor)
+        self._beliefs.append(None)
+
+    def connect(self, source: int, target: int) -> None:
+        """Connect two cliques in the tree."""
+
+        self._links.append((source, target))
 
     def initialise(self, factors: List[FactorLike]) -> "JunctionTree":
         """Initialise the tree given a set of factors."""
 
         factors = [factor.copy() for factor in factors]
         used = []
-        for i, attrs in self.graph.nodes.items():
-            factor = attrs["factor"]
+        for i, factor in enumerate(self._factors):
             for other in factors:
                 if len(np.intersect1d(factor.scope, other.scope)) == len(other.scope):
                     factor *= other
                     used.append(other)
             factors = [x for x in factors if x not in used]
-            self.graph.nodes[i]["factor"] = factor
-            self.graph.nodes[i]["cached"] = factor.copy()
+            self._factors[i] = factor
+            self._cached[i] = factor.copy()
+            self._beliefs[i] = None
+
+        if len(factors) > 0:
+            raise ValueError(
+                "Failed to assign factors to the tree: {0}.".format(
+                    ", ".join(str(x) for x in factors)
+                )
+            )
+
+        self._index_structure()
+        self._index_hosts()
+        self.evidence = {}
+
         return self
 
-    def calibrate(self) -> None:
-        """Calibrate the nodes on the tree."""
+    def calibrate(self, variables: Optional[List[int]] = None) -> None:
+        """
+        Calibrate the nodes on the tree.
+
+        Parameters
+        ----------
+        variables: list, optional
+            If provided, only the cliques from which the marginals of these variables
+            are read are calibrated. Other cliques are calibrated on a later call.
+
+        """
 
-        for node, attrs in self.graph.nodes.items():
-            factor = attrs["factor"]
+        if self.propagation == HUGIN:
+            # cliques are calibrated in place as they absorb from their neighbours.
+            return
 
-            for (source, target) in nx.edges(self.graph, node):
-                if target != source:
-                    factor *= self._message(target, source)
+        if variables is None:
+            nodes = range(len(self._factors))
+        else:
+            nodes = [
+                host[0]
+                for host in {self._marginal_host(x) for x in variables}
+                if len(host) == 1
+            ]
+
+        self._calibrate_nodes(nodes)
+
+    def propagate(self, variables: Optional[List[int]] = None) -> None:
+        """
+        Propagate belief across the tree.
+
+        Parameters
+        ----------
+        variables: list, optional
+            If provided, only the messages flowing towards the cliques and separators
+            hosting the marginals of these variables are sent, so a single marginal
+            costs one collect pass. Any other messages are sent if a later call needs
+            them. With HUGIN propagation, the trees hosting these variables are
+            propagated in full.
 
-            attrs.update(factor=factor)
+        """
 
-    def propagate(self) -> None:
-        """Propagate belief across the tree."""
+        if self.propagation == HUGIN:
+            self._absorb_all(self._roots(variables))
+            return
 
-        while self._message_count() < (2.0 * len(self.graph.edges)):
-            for (source, target) in self.graph.edges.keys():
-                if self._can_send(source, target):
-                    self._send_message(source, target)
+        if variables is None:
+            hosts = [(node,) for node in range(len(self._factors))]
+        else:
+            hosts = {self._marginal_host(x) for x in variables}
 
-                elif self._can_send(target, source):
-                    self._send_message(target, source)
+        self._send(self._pending(hosts))
 
     def update_observations(self, observations: List[List[int]]) -> None:
         """
         Update the observation state of the tree.
 
+        Only the cliques hosting changed evidence are re-initialised, and only the
+        messages flowing away from those cliques are invalidated. Messages that do not
+        depend on the changed evidence are reused by the next call to `propagate`.
+
         Parameters
         ----------
         observations: list
             A list of observations of the form [[var: int, obs: int], ..., [...]].
-            Where 'obs' is the observed evidence for the state of variable 'var'.
+            Where 'obs' is the observed evidence for the state of variable 'var'. An
+            'obs' of None retracts any evidence on variable 'var'.
+
+        """
+
+        evidence = dict(self.evidence)
+        for variable, state in observations or []:
+            if state is None:
+                evidence.pop(variable, None)
+            else:
+                evidence[variable] = int(state)
+
+        self.set_observations(evidence.items())
 
+    def set_observations(self, observations: List[List[int]]) -> None:
         """
+        Replace the observation state of the tree.
 
-        observations = observations or []
-        for variable, state in observations:
-            for node in self.graph.nodes:
-                factor = self.graph.nodes[node]["factor"]
-                if variable in factor.scope:
-                    factor = factor.reduce([variable, state])
-                    self.graph.nodes[node]["factor"] = factor
+        Parameters
+        ----------
+        observations: list
+            A list of observations of the form [[var: int, obs: int], ..., [...]].
+            Any evidence on variables not included in 'observations' is retracted.
+
+        """
+
+        evidence = {int(variable): int(state) for variable, state in observations or []}
+
+        changed = {
+            self._host(variable)
+            for variable in set(evidence) | set(self.evidence)
+            if evidence.get(variable) != self.evidence.get(variable)
+        }
+
+        self.evidence = evidence
+
+        for node in changed:
+            self._enter_evidence(node)
+            self._invalidate(node)
 
     def reset_observations(self) -> None:
         """Reset the observation state of the tree."""
 
-        for node in self.graph.nodes:
-            self.graph.nodes[node]["factor"] = self.graph.nodes[node]["cached"].copy()
+        self.set_observations([])
 
     def marginal(self, variable: int) -> FactorLike:
         """Compute the marginal distribution for the given variable."""
 
-        for factor in self.factors:
-            if variable in factor.scope:
-                return factor.marginalise(*np.setdiff1d(factor.scope, [variable]))
-
-        raise ValueError(
-            "Variable '{0}' was not found in the provided tree.".format(variable)
-        )
+        return next(self.marginals(variable))
 
     def marginals(self, *variables: Tuple[int]) -> FactorLike:
-        """Compute the marginal distribution for a collection of variables."""
+        """
+        Compute the marginal distribution for a collection of variables.
+
+        Each variable is marginalised from the smallest clique or separator containing
+        it. Variables sharing a host are extracted from a single marginalisation of
+        that host, and marginals are yielded in the order they were requested.
+        """
+
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for variable in variables:
+            groups.setdefault(self._marginal_host(variable), []).append(variable)
+
+        marginals = {}
+        for host, group in groups.items():
+            belief = self._belief(host)
+            belief = belief.marginalise(*np.setdiff1d(belief.scope, group))
+            for variable in group:
+                marginals[variable] = (
+                    belief.marginalise(*np.setdiff1d(belief.scope, [variable]))
+                    if len(belief.scope) > 1
+                    else belief
+                )
 
         for variable in variables:
-            yield self.marginal(variable)
+            yield marginals[variable]
+
+    def joint(self, *variables: Tuple[int]) -> FactorLike:
+        """
+        Compute the joint distribution over a collection of variables.
+
+        Variables that do not share a clique are combined over the minimal subtree
+        connecting their host cliques. Variables are summed out of the subtree from
+        its leaves inwards, dividing out the separator beliefs as each clique is
+        absorbed, so memory is bounded by the subtree rather than the full joint.
+
+        With Shafer-Shenoy propagation, any beliefs the query needs that have not
+        been computed yet (see `propagate`) are computed first.
+        """
+
+        variables = np.unique(variables)
+
+        hosts = [
+            node
+            for node, factor in enumerate(self._factors)
+            if subset(variables, factor.scope)
+        ]
+
+        if len(hosts) > 0:
+            node = min(hosts, key=lambda x: len(self._factors[x].parameters))
+            self._require([node])
+            belief = self._belief((node,))
+            return belief.marginalise(*difference1d(belief.scope, variables))
+
+        components: Dict[int, List[int]] = {}
+        for node in {self._host(variable) for variable in variables}:
+            components.setdefault(int(self._components[node]), []).append(node)
+
+        joint = None
+        for terminals in components.values():
+            factor = self._joint(variables, terminals)
+            joint = factor if joint is None else joint * factor
+
+        return joint
 
-    def _can_send(self, source: int, target: int) -> bool:
-        """Determine if messages can be sent from source node to target node."""
+    def _joint(self, variables: np.ndarray, terminals: List[int]) -> FactorLike:
+        """Compute a joint distribution over the subtree connecting the terminals."""
 
-        if self._message(source, target) is None:
-            neighbours = list(nx.neighbors(self.graph, source))
-            n_neighbours = len(neighbours)
-            n_received = sum(
-                self._has_received(neighbour, source) for neighbour in neighbours
+        root = terminals[0]
+        nodes = set().union(*[self._path(root, terminal) for terminal in terminals])
+        edges = self._bfs(root, nodes)
+        self._require(nodes)
+
+        messages: Dict[int, List[FactorLike]] = {node: [] for node in nodes}
+        for parent, child in reversed(edges):
+            factor = self._belief((child,))
+            for message in messages[child]:
+                factor = factor * message
+
+            separator = self._separator(child, parent)
+            factor = factor.marginalise(
+                *difference1d(factor.scope, union1d(separator, variables))
             )
+            messages[parent].append(factor / self._belief((child, parent)))
 
-            if n_received == n_neighbours - 1 and not self._has_received(
-                target, source
-            ):
-                return True
-            elif n_received == n_neighbours and self._has_received(target, source):
-                return True
+        factor = self._belief((root,))
+        for message in messages[root]:
+            factor = factor * message
 
-        return False
+        return factor.marginalise(*difference1d(factor.scope, variables))
 
-    def _message(self, source: int, target: int) -> FactorLike:
-        """Get the message sent between the source and target node."""
+    def log_evidence(self) -> float:
+        """
+        Compute the log probability of the current evidence, log P(e).
+
+        Messages (and, with HUGIN propagation, clique beliefs) are normalised as they
+        are computed, and the log of each normalising constant is accumulated. The
+        probability of the evidence is then read from any clique in each tree without
+        underflowing, even in single precision. Any uncalibrated trees are propagated
+        first.
+        """
+
+        if self.propagation == HUGIN:
+            self._absorb_all()
+
+        total = 0.0
+        for root in sorted(self._trees):
+            self._require([root])
+            belief = self._beliefs[root]
+
+            if belief is None:
+                raise ValueError("The tree must be calibrated before use.")
+
+            z = float(belief.parameters.sum())
+            total += self._scales[root] + (np.log(z) if z > 0 else -np.inf)
+
+        return float(total)
+
+    def propagate_batch(
+        self,
+        evidence: Dict[int, np.ndarray],
+        variables: Optional[List[int]] = None,
+        potentials: Optional[List[np.ndarray]] = None,
+    ) -> Dict[int, np.ndarray]:
+        """
+        Compute marginals for a batch of evidence sets in a single propagation.
+
+        Every clique potential and message carries a leading batch axis, so the cost
+        of a propagation is shared by every row in the batch. The evidence currently
+        entered into the tree is ignored.
+
+        Parameters
+        ----------
+        evidence: dict
+            A mapping of variables to integer arrays of observed states, one element
+            per row in the batch. A state of -1 indicates that the variable is
+            unobserved in that row.
+        variables: list, optional
+            The variables to compute marginals for. Defaults to every variable in the
+            tree.
+        potentials: list, optional
+            Batched clique potentials to use in place of the tree's own, one table of
+            shape (rows, *cards) (or (1, *cards)) per clique, over its scope.
+
+        Returns
+        -------
+        out: dict
+            A mapping of each variable to an array of shape (rows, cardinality) with
+            its normalised marginal distribution in each row. If no evidence is
+            provided, a single row is returned.
+
+        """
+
+        variables = list(self._hosts) if variables is None else variables
+
+        roots = self._roots(variables)
+        observed = roots & self._roots(evidence) if potentials is None else roots
+
+        potentials = self._potentials_batch(evidence, roots, base=potentials)
 
-        return self.graph.edges[(source, target)]["messages"][(source, target)]
+        for root in roots - observed:
+            # trees without evidence in this batch share their (cached) priors.
+            if root not in self._priors:
+                self._priors[root] = self._calibrate_batch(potentials, {root})
 
-    def _has_received(self, source: int, target: int) -> bool:
-        """Check if a message was sent between the source and target node."""
+        beliefs = self._calibrate_batch(potentials, observed)
+        for root in roots - observed:
+            beliefs.update(self._priors[root])
 
-        return True if self._message(source, target) is not None else False
+        marginals = {}
+        for variable in variables:
+            node = self._host(variable)
+            scope = self._cached[node].scope
+            table, _ = table_marginalise(beliefs[node], scope, [variable])
+            marginals[variable], _ = table_normalise(table)
+
+        return marginals
+
+    def log_evidence_batch(
+        self,
+        evidence: Dict[int, np.ndarray],
+        potentials: Optional[List[np.ndarray]] = None,
+    ) -> np.ndarray:
+        """
+        Compute the log probability of a batch of evidence sets, log P(e).
+
+        Each tree in the forest needs only a single (batched) collect pass. The
+        evidence currently entered into the tree is ignored.
+
+        Parameters
+        ----------
+        evidence: dict
+            A mapping of variables to integer arrays of observed states, as accepted
+            by `propagate_batch`.
+        potentials: list, optional
+            Batched clique potentials to use in place of the tree's own, as accepted
+            by `propagate_batch`.
+
+        Returns
+        -------
+        out: ndarray
+            The log probability of the evidence in each row. If no evidence is
+            provided, a single row is returned.
+
+        """
+
+        potentials = self._potentials_batch(evidence, base=potentials)
+        scopes = [factor.scope for factor in self._cached]
+
+        total = np.zeros(1)
+        with np.errstate(divide="ignore"):
+            for root, edges in self._traversals():
+                collected = {root: potentials[root]}
+                collected.update({child: potentials[child] for _, child in edges})
+
+                for parent, child in reversed(edges):
+                    separator = self._separators[child]
+                    message, _ = table_marginalise(
+                        collected[child], scopes[child], separator
+                    )
+                    message, z = table_normalise(message)
+                    total = total + np.log(z)
+                    collected[parent] = collected[parent] * table_expand(
+                        message, separator, scopes[parent]
+                    )
+
+                table = collected[root]
+                total = total + np.log(table.reshape(table.shape[0], -1).sum(axis=1))
+
+        return total
+
+    def _potentials_batch(
+        self,
+        evidence: Dict[int, np.ndarray],
+        roots: Optional[Set[int]] = None,
+        base: Optional[List[np.ndarray]] = None,
+    ) -> Dict[int, np.ndarray]:
+        """Build batched clique tables for the given trees, with evidence entered."""
+
+        roots = self._roots() if roots is None else roots
+
+        potentials = {}
+        for node, factor in enumerate(self._cached):
+            if self._components[node] in roots:
+                potentials[node] = (
+                    factor.parameters.reshape(1, *factor.cards)
+                    if base is None
+                    else base[node]
+                )
+
+        for variable, states in evidence.items():
+            node = self._host(variable)
+            if node not in potentials:
+                continue
+
+            scope = self._cached[node].scope
+            indicator = self._indicator(np.asarray(states), node, variable)
+            potentials[node] = potentials[node] * table_expand(
+                indicator, [variable], scope
+            )
+
+        return potentials
+
+    def _indicator(self, states: np.ndarray, node: int, variable: int) -> np.ndarray:
+        """Build a batch of evidence indicators for a variable in a clique."""
+
+        factor = self._cached[node]
+        card = int(factor.card(variable)[0])
+
+        observed = states >= 0
+        indicator = np.ones((len(states), card), dtype=factor.parameters.dtype)
+        indicator[observed] = 0.0
+        indicator[np.flatnonzero(observed), states[observed]] = 1.0
+
+        return indicator
+
+    def _calibrate_batch(
+        self, potentials: Dict[int, np.ndarray], roots: Optional[Set[int]] = None
+    ) -> Dict[int, np.ndarray]:
+        """Calibrate batched clique tables with a collect and distribute pass."""
+
+        scopes = [factor.scope for factor in self._cached]
+
+        def upward(parent: int, child: int) -> None:
+            separator = self._separators[child]
+            message, _ = table_marginalise(collected[child], scopes[child], separator)
+            messages[child], _ = table_normalise(message)
+
+        def downward(parent: int, child: int) -> None:
+            separator = self._separators[child]
+            message = table_expand(messages[child], separator, scopes[parent])
+            factor = np.divide(
+                beliefs[parent],
+                message,
+                out=np.zeros(
+                    np.broadcast(beliefs[parent], message).shape,
+                    dtype=beliefs[parent].dtype,
+                ),
+                where=message > 0,
+            )
+            message, _ = table_marginalise(factor, scopes[parent], separator)
+            message, _ = table_normalise(message)
+            beliefs[child] = collected[child] * table_expand(
+                message, separator, scopes[child]
+            )
+
+        beliefs = {}
+        for root, edges in self._traversals(roots):
+            collected = {root: potentials[root]}
+            collected.update({child: potentials[child] for _, child in edges})
+            messages = {}
+
+            levels = self._levels(root, edges)
+
+            # messages within a level are independent of one another.
+            for level in reversed(levels):
+                self._dispatch(upward, level)
+                for parent, child in level:
+                    separator = self._separators[child]
+                    collected[parent] = collected[parent] * table_expand(
+                        messages[child], separator, scopes[parent]
+                    )
+
+            beliefs[root] = collected[root]
+            for level in levels:
+                self._dispatch(downward, level)
+
+        return beliefs
+
+    def mpe(self) -> Tuple[Dict[int, int], float]:
+        """
+        Compute the most probable explanation (MPE) given the current evidence.
+
+        Max-product messages are collected towards the root of each tree in the
+        forest, and the assignment is then decoded from the root outwards by
+        maximising each clique given the states already chosen on its separator. The
+        stored sum-product messages are left untouched.
+
+        Messages are normalised as they are sent, and the log of each normalising
+        constant is accumulated, so the value of the assignment does not underflow,
+        even in single precision.
+
+        Returns
+        -------
+        assignment: dict
+            A mapping of each variable in the tree to its most probable state.
+        value: float
+            The log of the (unnormalised) value of the assignment under the tree's
+            potentials.
+
+        """
+
+        potentials = dict(enumerate(self._factors))
+
+        assignment: Dict[int, int] = {}
+        value = 0.0
+        for root, edges in self._traversals():
+            collected, _, scales = self._collect(potentials, root, edges, "maximise")
+            value += scales[root] + self._log(collected[root].max())
+            self._decode(collected, root, edges, assignment)
+
+        return assignment, float(value)
+
+    def top_k(self, k: int) -> List[Tuple[Dict[int, int], float]]:
+        """
+        Compute the 'k' most probable explanations given the current evidence.
+
+        This is an implementation of Nilsson's algorithm [4]. After each explanation
+        is found, the remaining assignments of its subproblem are partitioned clique by
+        clique (in tree order) into disjoint subproblems: the residual variables of
+        earlier cliques are fixed to the explanation, and the residual variables of
+        the current clique are constrained to differ from it. The best value of each
+        new subproblem is read directly from the max-calibrated clique beliefs, so
+        only one max-product calibration is needed per explanation returned.
+
+        References
+        ----------
+        [4] An efficient algorithm for finding the M most probable configurations in
+            probabilistic expert systems, D. Nilsson
+
+        Returns
+        -------
+        out: list
+            A list of up to 'k' tuples of the form (assignment, value), in decreasing
+            order of value, where each value is a log value (see `mpe`). Assignments
+            with zero probability are not returned.
+
+        """
+
+        potentials = dict(enumerate(self._factors))
+        traversals = self._traversals()
+
+        order = []
+        for root, edges in traversals:
+            order.append((root, None))
+            order.extend((child, parent) for parent, child in edges)
+
+        counter = count()
+        queue = [(0.0, next(counter), {}, [])]
+        explanations = []
+
+        while len(queue) > 0 and len(explanations) < k:
+            _, _, fixed, excluded = heappop(queue)
+
+            beliefs, scales = self._calibrate(
+                self._constrain(potentials, fixed, excluded), traversals, "maximise"
+            )
+
+            assignment: Dict[int, int] = {}
+            value = 0.0
+            for root, edges in traversals:
+                value += scales[root] + self._log(beliefs[root].max())
+                self._decode(beliefs, root, edges, assignment)
+
+            if not np.isfinite(value):
+                break
+
+            explanations.append((assignment, float(value)))
+
+            previous = dict(fixed)
+            for node, parent in order:
+                belief = beliefs[node]
+                separator = self._separators[node] if parent is not None else []
+                residual = np.setdiff1d(belief.scope, separator)
+                states = [assignment[x] for x in residual]
+
+                best = belief.parameters[
+                    int(belief.index([assignment[x] for x in belief.scope]))
+                ]
+                alternative = self._exclude(
+                    belief.reduce(*[[x, assignment[x]] for x in separator]),
+                    residual,
+                    states,
+                )
+
+                # the bound is relative to the explanation, so beliefs need no scale.
+                bound = value + self._log(alternative.max()) - self._log(best)
+                if np.isfinite(bound):
+                    heappush(
+                        queue,
+                        (
+                            -bound,
+                            next(counter),
+                            dict(previous),
+                            excluded + [(node, residual, states)],
+                        ),
+                    )
+
+                previous.update(zip(residual.tolist(), states))
+
+        return explanations
+
+    def close(self) -> None:
+        """Stop the worker threads, if any are running."""
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _dispatch(self, func: Callable[..., None], arguments: List[tuple]) -> None:
+        """Call a function for each set of arguments, using the worker pool if set."""
+
+        if self.workers is None or len(arguments) < 2:
+            for args in arguments:
+                func(*args)
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        for future in [self._executor.submit(func, *args) for args in arguments]:
+            future.result()
+
+    @staticmethod
+    def _levels(
+        root: int, edges: List[Tuple[int, int]]
+    ) -> List[List[Tuple[int, int]]]:
+        """Group breadth-first (parent, child) edges by the depth of the child."""
+
+        depths = {root: 0}
+        levels: List[List[Tuple[int, int]]] = []
+        for parent, child in edges:
+            depths[child] = depths[parent] + 1
+            if depths[child] > len(levels):
+                levels.append([])
+            levels[depths[child] - 1].append((parent, child))
+
+        return levels
+
+    def _traversals(
+        self, roots: Optional[Set[int]] = None
+    ) -> List[Tuple[int, List[Tuple[int, int]]]]:
+        """Get a root and breadth-first (parent, child) edges for each (given) tree."""
+
+        roots = self._trees if roots is None else roots
+
+        return [(root, self._trees[root]) for root in sorted(roots)]
+
+    def _roots(self, variables: Optional[List[int]] = None) -> Set[int]:
+        """Get the roots of the trees hosting the given (by default, all) variables."""
+
+        if variables is None:
+            return set(self._trees)
+
+        return {int(self._components[self._host(variable)]) for variable in variables}
+
+    def _index_structure(self) -> None:
+        """
+        Build the parent, child and message arrays of the forest from its links.
+
+        Each tree is rooted at its lowest-numbered clique, which is also its largest
+        (cliques are numbered by decreasing size), and its edges are ordered
+        breadth-first from there.
+        """
+
+        n = len(self._factors)
+
+        adjacent: List[List[int]] = [[] for _ in range(n)]
+        for source, target in self._links:
+            adjacent[source].append(target)
+            adjacent[target].append(source)
+
+        parents = np.full(n, -1, dtype=np.int64)
+        components = np.full(n, -1, dtype=np.int64)
+        depths = [0] * n
+        self._trees = {}
+
+        for root in range(n):
+            if components[root] >= 0:
+                continue
+
+            components[root] = root
+            edges, queue = [], [root]
+            for node in queue:
+                for other in adjacent[node]:
+                    if other == parents[node]:
+                        continue
+                    if components[other] >= 0:
+                        raise ValueError(
+                            "The junction tree contains one or more cycles."
+                        )
+                    parents[other], components[other] = node, root
+                    depths[other] = depths[node] + 1
+                    edges.append((node, other))
+                    queue.append(other)
+
+            self._trees[root] = edges
+
+        edges = [edge for root in sorted(self._trees) for edge in self._trees[root]]
+        children = sorted(edges)
+
+        self._parents = parents
+        self._components = components
+        self._children = np.asarray([child for _, child in children], dtype=np.int64)
+        self._offsets = np.searchsorted(
+            np.asarray([parent for parent, _ in children], dtype=np.int64),
+            np.arange(n + 1),
+        )
+
+        # plain lists of the same structure, for fast scalar access when propagating.
+        self._parent_of = parents.tolist()
+        self._depth_of = depths
+        self._adjacency = [
+            self._children[self._offsets[i] : self._offsets[i + 1]].tolist()
+            + ([self._parent_of[i]] if self._parent_of[i] >= 0 else [])
+            for i in range(n)
+        ]
+
+        self._separators = [None] * n
+        for parent, child in edges:
+            self._separators[child] = np.intersect1d(
+                self._factors[parent].scope, self._factors[child].scope
+            )
+
+        self._potentials = [None] * n
+        self._messages = [None] * (2 * n)
+        self._message_scales = np.zeros(2 * n)
+        self._scales = np.zeros(n)
+        self._priors = {}
+
+    def _neighbours(self, node: int) -> List[int]:
+        """Get the neighbours of a clique."""
+
+        return self._adjacency[node]
+
+    def _slot(self, source: int, target: int) -> int:
+        """Get the slot of the message sent from the source to the target clique."""
+
+        if self._parent_of[source] == target:
+            return source
+
+        return len(self._factors) + target
+
+    def _separator(self, source: int, target: int) -> np.ndarray:
+        """Get the separator between two neighbouring cliques."""
+
+        if self._parent_of[source] == target:
+            return self._separators[source]
+
+        return self._separators[target]
+
+    def _path(self, source: int, target: int) -> List[int]:
+        """Get the cliques on the path between two cliques in the same tree."""
+
+        ancestors = [source]
+        while self._parents[ancestors[-1]] >= 0:
+            ancestors.append(int(self._parents[ancestors[-1]]))
+
+        path = [target]
+        while path[-1] not in ancestors:
+            path.append(int(self._parents[path[-1]]))
+
+        return ancestors[: ancestors.index(path[-1])] + path
+
+    def _bfs(self, root: int, nodes: Set[int]) -> List[Tuple[int, int]]:
+        """Get the breadth-first (parent, child) edges of a subtree from 'root'."""
+
+        edges, queue, seen = [], [root], {root}
+        for node in queue:
+            for other in self._neighbours(node):
+                if other in nodes and other not in seen:
+                    seen.add(other)
+                    edges.append((node, other))
+                    queue.append(other)
+
+        return edges
+
+    def _collect(
+        self,
+        potentials: Dict[int, FactorLike],
+        root: int,
+        edges: List[Tuple[int, int]],
+        operation: str = "marginalise",
+    ) -> Tuple[Dict[int, FactorLike], Dict[int, FactorLike], Dict[int, float]]:
+        """
+        Collect messages towards a root, returning each clique's collected factor.
+
+        Messages are normalised as they are sent (see `_send_message`), so collected
+        factors are only known up to a constant: the log of each is returned too.
+
+        Parameters
+        ----------
+        potentials: dict
+            The potentials of the cliques in the tree.
+        root: int
+            The clique towards which messages are collected.
+        edges: list
+            The (parent, child) edges of the tree in breadth-first order from 'root'.
+        operation: str
+            The factor method used to eliminate variables when sending messages,
+            either 'marginalise' (sum-product) or 'maximise' (max-product).
+
+        Returns
+        -------
+        collected: dict
+            The product of each clique's potential and the messages from its children.
+        messages: dict
+            The (normalised) message sent from each child clique to its parent.
+        scales: dict
+            The log of the constant dividing each clique's collected factor.
+
+        """
+
+        collected = {root: potentials[root]}
+        collected.update({child: potentials[child] for _, child in edges})
+        messages = {}
+        scales = dict.fromkeys(collected, 0.0)
+
+        for parent, child in reversed(edges):
+            factor = collected[child]
+            separator = self._separators[child]
+            messages[child], z = self._normalise(
+                getattr(factor, operation)(*np.setdiff1d(factor.scope, separator))
+            )
+            collected[parent] = collected[parent] * messages[child]
+            scales[parent] += scales[child] + z
+
+        return collected, messages, scales
+
+    def _calibrate(
+        self,
+        potentials: Dict[int, FactorLike],
+        traversals: List[Tuple[int, List[Tuple[int, int]]]],
+        operation: str = "marginalise",
+    ) -> Tuple[Dict[int, FactorLike], Dict[int, float]]:
+        """
+        Calibrate a set of clique potentials with a collect and distribute pass,
+        returning the beliefs and the log scale of the belief at each root.
+        """
+
+        beliefs, roots = {}, {}
+        for root, edges in traversals:
+            collected, messages, scales = self._collect(
+                potentials, root, edges, operation
+            )
+            beliefs[root], roots[root] = collected[root], scales[root]
+
+            for parent, child in edges:
+                separator = self._separators[child]
+                factor = beliefs[parent] / messages[child]
+                message, _ = self._normalise(
+                    getattr(factor, operation)(*np.setdiff1d(factor.scope, separator))
+                )
+                beliefs[child] = collected[child] * message
+
+        return beliefs, roots
+
+    def _decode(
+        self,
+        factors: Dict[int, FactorLike],
+        root: int,
+        edges: List[Tuple[int, int]],
+        assignment: Dict[int, int],
+    ) -> None:
+        """Decode a maximal assignment from the root of a max-product tree outwards."""
+
+        factor = factors[root]
+        states = factor.assignment(factor.argmax())
+        assignment.update(zip(factor.scope.tolist(), states.tolist()))
+
+        for parent, child in edges:
+            separator = self._separators[child]
+            factor = factors[child].reduce(*[[x, assignment[x]] for x in separator])
+            states = factor.assignment(factor.argmax())
+            assignment.update(zip(factor.scope.tolist(), states.tolist()))
+
+    def _constrain(
+        self,
+        potentials: Dict[int, FactorLike],
+        fixed: Dict[int, int],
+        excluded: List[Tuple[int, np.ndarray, List[int]]],
+    ) -> Dict[int, FactorLike]:
+        """Apply fixed and excluded assignments to a set of clique potentials."""
+
+        potentials = dict(potentials)
+
+        for variable, state in fixed.items():
+            node = self._host(variable)
+            potentials[node] = potentials[node].reduce([variable, state])
+
+        for node, variables, states in excluded:
+            potentials[node] = self._exclude(potentials[node], variables, states)
+
+        return potentials
+
+    @staticmethod
+    def _exclude(
+        factor: FactorLike, variables: np.ndarray, states: List[int]
+    ) -> FactorLike:
+        """Zero the entries of a factor matching an assignment to some variables."""
+
+        mapping = [factor.scope.tolist().index(x) for x in variables]
+        mask = np.all(factor.assignments[:, mapping] == states, axis=1)
+        parameters = np.where(mask, 0.0, factor.parameters)
+
+        return type(factor)(factor.scope, factor.cards, parameters)
+
+    def _pending(self, hosts: Iterable[Tuple[int, ...]]) -> Set[Tuple[int, int]]:
+        """Find the unsent messages needed to read beliefs at the given hosts."""
+
+        stack = []
+        for host in hosts:
+            if len(host) == 1:
+                stack.extend((x, host[0]) for x in self._neighbours(host[0]))
+            else:
+                stack.extend([host, host[::-1]])
+
+        pending = set()
+        while len(stack) > 0:
+            source, target = stack.pop()
+            # a message is only ever sent once all of the messages it depends on are.
+            slot = self._slot(source, target)
+            if (source, target) in pending or self._messages[slot] is not None:
+                continue
+
+            pending.add((source, target))
+            stack.extend((x, source) for x in self._neighbours(source) if x != target)
+
+        return pending
+
+    def _send(self, messages: Set[Tuple[int, int]]) -> None:
+        """
+        Send a set of messages, along with any unsent messages they depend on.
+
+        Upward messages are sent deepest first, then downward messages shallowest
+        first. Messages between cliques at the same depth are independent of one
+        another, and are dispatched together.
+        """
+
+        n = len(self._factors)
+        levels: Dict[Tuple[int, int], List[Tuple[int, int]]] = {}
+        for source, target in messages:
+            if self._slot(source, target) < n:
+                key = (0, -self._depth_of[source])
+            else:
+                key = (1, self._depth_of[target])
+            levels.setdefault(key, []).append((source, target))
+
+        for key in sorted(levels):
+            self._dispatch(self._send_message, levels[key])
+
+    def _require(self, nodes: Iterable[int]) -> None:
+        """Compute any missing beliefs at the given cliques (Shafer-Shenoy only)."""
+
+        if self.propagation == SHAFER_SHENOY:
+            self._send(self._pending([(x,) for x in nodes]))
+            self._calibrate_nodes(nodes)
+
+    def _calibrate_nodes(self, nodes: Iterable[int]) -> None:
+        """Compute the beliefs of the given cliques from their incoming messages."""
+
+        def belief(node: int) -> None:
+            factor = self._factors[node]
+            scale = 0.0
+
+            for other in self._neighbours(node):
+                slot = self._slot(other, node)
+                if self._messages[slot] is None:
+                    raise ValueError("The tree must be propagated before calibration.")
+                factor = factor * self._messages[slot]
+                scale += self._message_scales[slot]
+
+            self._beliefs[node] = factor
+            self._scales[node] = scale
+
+        self._dispatch(belief, [(x,) for x in nodes if self._beliefs[x] is None])
+
+    @staticmethod
+    def _log(value: float) -> float:
+        """Take the log of a non-negative value, mapping zero to -inf."""
+
+        return float(np.log(value)) if value > 0 else -np.inf
+
+    @staticmethod
+    def _normalise(factor: FactorLike) -> Tuple[FactorLike, float]:
+        """Normalise a factor to sum to one, returning it and its log normaliser."""
+
+        z = float(factor.parameters.sum())
+        if z <= 0:
+            return factor, -np.inf
+
+        parameters = factor.parameters / z
+        return type(factor)(factor.scope, factor.cards, parameters), np.log(z)
+
+    def _message(self, source: int, target: int) -> FactorLike:
+        """Get the message sent between the source and target node."""
+
+        return self._messages[self._slot(source, target)]
 
     def _send_message(self, source: int, target: int) -> None:
         """Send a message between the source and target node."""
 
-        source_factor = self.graph.nodes[source]["factor"].copy()
-        target_factor = self.graph.nodes[target]["factor"].copy()
+        factor = self._factors[source]
+        scale = 0.0
+
+        for other in self._neighbours(source):
+            if other != target:
+                slot = self._slot(other, source)
+                factor = factor * self._messages[slot]
+                scale += self._message_scales[slot]
+
+        targets = np.setdiff1d(factor.scope, self._separator(source, target))
+        factor, z = self._normalise(factor.marginalise(*targets))
+
+        # messages are normalised, and carry the log of what was divided out.
+        slot = self._slot(source, target)
+        self._messages[slot] = factor
+        self._message_scales[slot] = scale + z
+
+    def _host(self, variable: int) -> int:
+        """Get the clique into which evidence on the given variable is entered."""
+
+        if variable not in self._hosts:
+            raise ValueError(
+                "Variable '{0}' was not found in the provided tree.".format(variable)
+            )
+
+        return self._hosts[variable]
+
+    def _marginal_host(self, variable: int) -> Tuple[int, ...]:
+        """Get the clique or separator from which a variable's marginal is read."""
+
+        if variable not in self._marginal_hosts:
+            raise ValueError(
+                "Variable '{0}' was not found in the provided tree.".format(variable)
+            )
+
+        return self._marginal_hosts[variable]
+
+    def _index_hosts(self) -> None:
+        """Find the smallest clique and separator tables containing each variable."""
+
+        self._hosts = {}
+        self._marginal_hosts = {}
+
+        sizes: Dict[int, int] = {}
+        for node, factor in enumerate(self._factors):
+            for variable in factor.scope:
+                if len(factor.parameters) < sizes.get(variable, np.inf):
+                    sizes[variable] = len(factor.parameters)
+                    # evidence is entered into the smallest clique containing it.
+                    self._hosts[variable] = node
+                    self._marginal_hosts[variable] = (node,)
+
+        for child, separator in enumerate(self._separators):
+            if separator is None:
+                continue
+
+            factor = self._factors[child]
+            size = int(np.prod([factor.card(x)[0] for x in separator]))
+            for variable in separator:
+                if size < sizes[variable]:
+                    sizes[variable] = size
+                    self._marginal_hosts[variable] = (int(self._parents[child]), child)
+
+    def _belief(self, host: Tuple[int, ...]) -> FactorLike:
+        """Get the calibrated belief over a clique or separator."""
 
-        source_scope = source_factor.scope
-        target_scope = target_factor.scope
+        if len(host) == 1:
+            belief = self._beliefs[host[0]]
 
-        for source, other in nx.edges(self.graph, source):
-            if other != target and self._message(other, source) is not None:
-                source_factor *= self._message(other, source)
+        elif self.propagation == HUGIN:
+            source, target = host
+            child = source if self._parents[source] == target else target
+            belief = self._potentials[child]
+            if any(self._beliefs[x] is None for x in host):
+                belief = None
 
-        targets = [
-            x
-            for x in source_scope
-            if x not in [x for x in source_scope if x in target_scope]
+        else:
+            source, target = host
+            forward, backward = (
+                self._message(source, target),
+                self._message(target, source),
+            )
+            belief = (
+                forward * backward
+                if forward is not None and backward is not None
+                else None
+            )
+
+        if belief is None:
+            raise ValueError("The tree must be calibrated before use.")
+
+        return belief
+
+    def _enter_evidence(self, node: int) -> None:
+        """Rebuild the potential of a clique from its cache and current evidence."""
+
+        factor = self._cached[node].copy()
+        evidence = [
+            [variable, state]
+            for variable, state in self.evidence.items()
+            if self._hosts[variable] == node
         ]
-        source_factor = source_factor.marginalise(*targets)
 
-        self.graph.edges[(source, target)]["messages"][(source, target)] = source_factor
+        if len(evidence) > 0:
+            factor = factor.reduce(*evidence)
+
+        self._factors[node] = factor
+
+    def _invalidate(self, node: int) -> None:
+        """Discard the beliefs and messages that depend on the given clique."""
+
+        if self.propagation == HUGIN:
+            # absorbed potentials cannot be partially rolled back.
+            for other in np.flatnonzero(self._components == self._components[node]):
+                self._beliefs[other] = None
+            return
+
+        self._beliefs[node] = None
+
+        stack = [(node, None)]
+        while len(stack) > 0:
+            source, parent = stack.pop()
+            for target in self._neighbours(source):
+                slot = self._slot(source, target)
+                # downstream messages cannot have been sent without this one.
+                if target != parent and self._messages[slot] is not None:
+                    self._messages[slot] = None
+                    self._beliefs[target] = None
+                    stack.append((target, source))
+
+    def _absorb_all(self, roots: Optional[Set[int]] = None) -> None:
+        """Run a HUGIN collect and distribute pass over each uncalibrated tree."""
 
-    def _message_count(self) -> int:
-        """Calculate the total number of messages sent."""
+        for root, edges in self._traversals(roots):
+            if self._beliefs[root] is not None:
+                continue
 
-        messages = 0
-        for k, v in nx.get_edge_attributes(self.graph, "messages").items():
-            for _, z in v.items():
-                if z is not None:
-                    messages += 1
+            for node in [root] + [child for _, child in edges]:
+                self._beliefs[node], self._scales[node] = self._normalise(
+                    self._factors[node]
+                )
 
-        return messages
+            for _, child in edges:
+                self._potentials[child] = None
+
+            for parent, child in reversed(edges):
+                self._absorb(child, parent)
+
+            for parent, child in edges:
+                self._absorb(parent, child)
+
+    def _absorb(self, source: int, target: int) -> None:
+        """Absorb the belief of the source clique into the target clique."""
+
+        child = source if self._parents[source] == target else target
+        belief = self._beliefs[source]
+
+        potential = belief.marginalise(
+            *np.setdiff1d(belief.scope, self._separators[child])
+        )
+
+        # beliefs are kept normalised, with the log of their scale tracked alongside.
+        if self._potentials[child] is None:
+            belief, z = self._normalise(self._beliefs[target] * potential)
+            self._scales[target] += self._scales[source] + z
+        else:
+            update = potential / self._potentials[child]
+            belief, _ = self._normalise(self._beliefs[target] * update)
+            self._scales[target] = self._scales[source]
+
+        self._beliefs[target] = belief
+
+        self._potentials[child] = potential
+
+    def __contains__(self, variable: int) -> bool:
+        """Check if a variable is in the scope of the tree."""
+
+        return variable in self._hosts
 
     @property
     def factors(self) -> Generator[FactorLike, None, None]:
         """Yield factors in the tree."""
 
-        for node in self.graph.nodes.values():
-            yield node["factor"]
+        for factor in self._factors:
+            yield factor
+
+    @property
+    def beliefs(self) -> Generator[FactorLike, None, None]:
+        """Yield the calibrated beliefs of the cliques in the tree."""
+
+        for belief in self._beliefs:
+            if belief is None:
+                raise ValueError("The tree must be calibrated before use.")
+            yield belief
+
+    @property
+    def edges(self) -> List[Tuple[int, int]]:
+        """Get the (parent, child) edges of each tree, breadth-first from its root."""
+
+        return [edge for _, edges in self._traversals() for edge in edges]
+
+    def to_networkx(self) -> nx.Graph:
+        """Export the tree as a graph, with clique and separator attributes."""
+
+        graph = nx.Graph()
+        for node, (factor, belief) in enumerate(zip(self._factors, self._beliefs)):
+            graph.add_node(node, factor=factor, belief=belief)
+
+        for parent, child in self.edges:
+            graph.add_edge(parent, child, separator=self._separators[child])
+
+        return graph
+
+    def validate(self) -> None:
+        """Check that the tree satisfies the running intersection property."""
+
+        self._index_structure()
+
+        # the cliques containing a variable are connected if and only if they are
+        # joined by one fewer edge than there are cliques.
+        counts: Dict[int, int] = {}
+        for factor in self._factors:
+            for variable in factor.scope:
+                counts[variable] = counts.get(variable, 0) + 1
+
+        for separator in self._separators:
+            for variable in separator if separator is not None else []:
+                counts[variable] -= 1
+
+        for variable, remaining in sorted(counts.items()):
+            if remaining != 1:
+                raise ValueError(
+                    "The junction tree violates the running intersection property "
+                    "for variable '{0}'.".format(variable)
+                )
+
+    def to_arrays(self) -> Dict[Text, np.ndarray]:
+        """
+        Export the compiled tree as a collection of flat arrays.
+
+        The scopes, cardinalities and initial potentials of the cliques are each
+        concatenated into a single array, with offsets marking where each clique
+        starts. The (parent, child) edges are stored in breadth-first order.
+        """
+
+        scopes = [np.asarray(factor.scope, dtype=np.int64) for factor in self._cached]
+        potentials = [
+            np.asarray(factor.parameters, dtype=np.float32) for factor in self._cached
+        ]
+
+        return dict(
+            propagation=np.asarray(self.propagation),
+            scopes=np.concatenate(scopes),
+            cards=np.concatenate([factor.cards for factor in self._cached]),
+            scope_offsets=np.cumsum([0] + [len(x) for x in scopes]),
+            potentials=np.concatenate(potentials),
+            potential_offsets=np.cumsum([0] + [len(x) for x in potentials]),
+            edges=np.asarray(self.edges, dtype=np.int64).reshape(-1, 2),
+        )
+
+    @classmethod
+    def from_arrays(
+        cls, arrays: Dict[Text, np.ndarray], **kwargs: Optional[Any]
+    ) -> "JunctionTree":
+        """
+        Rebuild a compiled tree from the arrays created by `to_arrays`.
+
+        Clique potentials are views of the 'potentials' array, so a tree loaded from
+        memory-mapped (or shared) arrays does not copy them.
+        """
+
+        kwargs.setdefault("propagation", str(arrays["propagation"]))
+        tree = cls(**kwargs)
+
+        scopes, cards = arrays["scopes"], arrays["cards"]
+        potentials = arrays["potentials"]
+        scope_offsets = arrays["scope_offsets"]
+        potential_offsets = arrays["potential_offsets"]
+
+        for node in range(len(scope_offsets) - 1):
+            a, b = scope_offsets[node], scope_offsets[node + 1]
+            c, d = potential_offsets[node], potential_offsets[node + 1]
+            tree.add(node, DiscreteFactor(scopes[a:b], cards[a:b], potentials[c:d]))
+
+        for source, target in arrays["edges"]:
+            tree.connect(int(source), int(target))
+
+        return tree.initialise([])
+
+    def save(self, filename: Text) -> None:
+        """Save the compiled tree to an '.npz' archive."""
+
+        io.arrays.save(filename, **self.to_arrays())
 
     @classmethod
-    def from_factors(cls, factor_set: FactorSetLike) -> "JunctionTree":
-        """Create a JT from a provided FactorSet object."""
+    def load(
+        cls, filename: Text, mmap: bool = True, **kwargs: Optional[Any]
+    ) -> "JunctionTree":
+        """Load a compiled tree from an '.npz' archive, memory-mapping potentials."""
 
-        tree = cls()
+        return cls.from_arrays(io.arrays.load(filename, mmap=mmap), **kwargs)
 
-        factor_scopes = [x.scope.tolist() for x in factor_set]
-        for variable, _ in zip(*get_elimination_ordering(factor_set.adjacency_matrix)):
-            current_factor_scope = union1d(
-                *[scope for scope in factor_scopes if variable in scope]
-            )
-            current_tau_scope = difference1d(current_factor_scope, [variable]).tolist()
+    @classmethod
+    def from_factors(
+        cls,
+        factor_set: FactorSetLike,
+        max_bytes: Optional[int] = None,
+        **kwargs: Optional[Any]
+    ) -> "JunctionTree":
+        """
+        Create a JT from a provided FactorSet object.
+
+        Parameters
+        ----------
+        factor_set: FactorSet
+            The factors to compile.
+        max_bytes: int, optional
+            A ceiling on the estimated size of the tree's tables (see `complexity`).
+            If the estimate exceeds it, a ValueError is raised before any tables
+            are allocated.
+        kwargs: optional
+            Keyword arguments passed to the JunctionTree.
 
-            current_neighbour_scopes = [x for x in factor_scopes if variable in x]
+        """
 
-            tree.add(
-                variable,
-                factor_set.new_factor(current_factor_scope),
-                current_tau_scope,
-                current_neighbour_scopes,
-            )
+        cliques = cls._maximal_cliques(factor_set)
+        edges = cls._spanning_tree(cliques)
 
-            factor_scopes = [scope for scope in factor_scopes if variable not in scope]
+        if max_bytes is not None:
+            required = cls._complexity(factor_set, cliques, edges)["table_bytes"]
+            if required > max_bytes:
+                raise ValueError(
+                    "Compiling this junction tree requires an estimated {0} bytes, "
+                    "exceeding the limit of {1} bytes.".format(required, max_bytes)
+                )
 
-            if current_tau_scope not in factor_scopes:
-                factor_scopes.append(current_tau_scope)
+        tree = cls(**kwargs)
 
+        for node, clique in enumerate(cliques):
+            tree.add(node, factor_set.new_factor(clique))
+
+        for source, target in edges:
+            tree.connect(source, target)
+
+        tree.validate()
         tree.initialise(factor_set.factors)
 
         return tree
+
+    @property
+    def table_bytes(self) -> int:
+        """Get the estimated size in bytes of the tree's tables (see `complexity`)."""
+
+        cliques = [factor.scope for factor in self._cached]
+        edges = [(int(parent), child) for child, parent in enumerate(self._parents)]
+        return self._complexity(
+            FactorSet(*self._cached), cliques, [x for x in edges if x[0] >= 0]
+        )["table_bytes"]
+
+    @classmethod
+    def complexity(cls, factor_set: FactorSetLike) -> Dict[str, int]:
+        """
+        Estimate the cost of compiling a set of factors, without allocating tables.
+
+        Returns
+        -------
+        out: dict
+            The number of cliques, the treewidth (the size of the largest clique
+            less one), the number of states in the largest clique, the total size
+            in bytes of the clique and message tables, and a rough count of the
+            floating point operations used by a full propagation.
+
+        """
+
+        cliques = cls._maximal_cliques(factor_set)
+        return cls._complexity(factor_set, cliques, cls._spanning_tree(cliques))
+
+    @staticmethod
+    def _complexity(
+        factor_set: FactorSetLike,
+        cliques: List[np.ndarray],
+        edges: List[Tuple[int, int]],
+    ) -> Dict[str, int]:
+        """Estimate the cost of a tree over the given cliques and edges."""
+
+        cards = {
+            int(var): int(np.ravel(card)[0])
+            for var, card in zip(factor_set.vars, factor_set.cards)
+        }
+
+        # python integers, as state counts can readily overflow fixed-width types.
+        def states(scope: Iterable[int]) -> int:
+            size = 1
+            for var in scope:
+                size *= cards[int(var)]
+            return size
+
+        sizes = [states(clique) for clique in cliques]
+        separators = [
+            states(np.intersect1d(cliques[i], cliques[j])) for i, j in edges
+        ]
+
+        degrees = [0] * len(cliques)
+        for i, j in edges:
+            degrees[i] += 1
+            degrees[j] += 1
+
+        # each clique sends one message per neighbour, each taking a product with
+        # (and a sum over) its table, then combines every message into its belief.
+        flops = sum(size * (d * d + d + 1) for size, d in zip(sizes, degrees))
+
+        # a potential and a belief per clique, and a message in each direction.
+        itemsize = np.dtype(np.float32).itemsize
+        table_bytes = itemsize * (2 * sum(sizes) + 2 * sum(separators))
+
+        return {
+            "cliques": len(cliques),
+            "treewidth": max((len(c) for c in cliques), default=1) - 1,
+            "max_clique_states": max(sizes, default=0),
+            "table_bytes": table_bytes,
+            "flops": flops,
+        }
+
+    @staticmethod
+    def _maximal_cliques(factor_set: FactorSetLike) -> List[np.ndarray]:
+        """Find the maximal cliques induced by eliminating variables in a set."""
+
+        ordering, scopes = get_elimination_ordering(factor_set.adjacency_matrix)
+
+        # the ordering is over positions in the set's (sorted) variables.
+        variables = factor_set.vars
+        cliques = [
+            variables[union1d([position], scope).astype(int)]
+            for position, scope in zip(ordering, scopes)
+        ]
+
+        maximal = []
+        for clique in sorted(cliques, key=len, reverse=True):
+            if not any(subset(clique, other) for other in maximal):
+                maximal.append(clique)
+
+        return maximal
+
+    @staticmethod
+    def _spanning_tree(cliques: List[np.ndarray]) -> List[Tuple[int, int]]:
+        """Connect cliques with a maximum-weight spanning tree on separator size."""
+
+        graph = nx.Graph()
+        graph.add_nodes_from(range(len(cliques)))
+        for i, j in combinations(range(len(cliques)), 2):
+            weight = len(np.intersect1d(cliques[i], cliques[j]))
+            if weight > 0:
+                graph.add_edge(i, j, weight=weight)
+
+        return list(nx.maximum_spanning_tree(graph, weight="weight").edges)
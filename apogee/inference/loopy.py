@@ -0,0 +1,410 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+from heapq import heappop, heappush
+from itertools import count
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from apogee.core import table_expand, table_marginalise
+from apogee.factors import DiscreteFactor
+from apogee.utils.typing import FactorLike, FactorSetLike
+
+from .base import Engine
+
+
+SYNCHRONOUS = "synchronous"
+RESIDUAL = "residual"
+
+
+class LoopyBeliefPropagation(Engine):
+    """
+    An implementation of loopy belief propagation on a factor graph.
+
+    Messages are passed between the factors of a FactorSet and the variables in their
+    scopes until they stop changing, and the marginal of each variable is read from
+    the product of its incoming messages. Unlike the junction tree algorithm, no
+    cliques are formed, so the cost of an iteration is linear in the size of the
+    factors, but the marginals are approximate on graphs with cycles [1].
+
+    Two schedules are supported. The default 'synchronous' schedule recomputes every
+    message from the previous iteration's messages at once: factors with the same
+    shape are stacked into a single batched table, so an iteration is a handful of
+    vectorised operations per group of factors. The 'residual' schedule [2] updates
+    one message at a time, always picking the message that would change the most,
+    which typically converges in fewer updates, and more often, on hard models.
+
+    References
+    ----------
+    [1] Probabilistic Graphical Models, Principles and Techniques,
+        D. Koller, N. Friedman
+    [2] Residual Belief Propagation: Informed Scheduling for Asynchronous Message
+        Passing, G. Elidan, I. McGraw, D. Koller (UAI 2006)
+
+    """
+
+    def __init__(
+        self,
+        mode: str = SYNCHRONOUS,
+        damping: float = 0.0,
+        tolerance: float = 1e-6,
+        max_iterations: int = 100,
+    ):
+        """
+        Create a new LoopyBeliefPropagation instance.
+
+        Parameters
+        ----------
+        mode: str, optional
+            The message schedule, either 'synchronous' (the default) or 'residual'.
+        damping: float, optional
+            The weight given to the previous value of a message when it is updated,
+            in [0, 1). Damping helps propagation converge on strongly coupled models.
+        tolerance: float, optional
+            Propagation stops once no message would change by more than this.
+        max_iterations: int, optional
+            The maximum number of iterations. With the residual schedule, this is a
+            cap of this many updates per message (on average).
+
+        """
+
+        if mode not in (SYNCHRONOUS, RESIDUAL):
+            raise ValueError("Unknown message schedule '{0}'.".format(mode))
+
+        if not 0.0 <= damping < 1.0:
+            raise ValueError("Damping must be in [0, 1), got {0}.".format(damping))
+
+        self.mode = mode
+        self.damping = damping
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.evidence: Dict[int, int] = {}
+        self.iterations = 0
+        self.converged = False
+
+        # variables, indexed by position.
+        self._variables = np.zeros(0, dtype=np.int64)
+        self._cards = np.zeros(0, dtype=np.int64)
+        self._positions: Dict[int, int] = {}
+        self._unary = np.zeros((0, 0))
+
+        # factors, indexed by the order added, and their (stacked) groups.
+        self._scopes: List[np.ndarray] = []
+        self._tables: List[np.ndarray] = []
+        self._groups: List[Tuple[np.ndarray, np.ndarray]] = []
+
+        # edges, sorted by variable. Row 'e' of the messages holds the message from
+        # the factor on edge 'e' to its variable, padded to the largest cardinality.
+        self._edges: List[np.ndarray] = []
+        self._edge_variables = np.zeros(0, dtype=np.int64)
+        self._edge_factors = np.zeros(0, dtype=np.int64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._mask = np.zeros((0, 0), dtype=bool)
+        self._messages = np.zeros((0, 0))
+        self._stale = True
+
+    def initialise(self, factors: List[FactorLike]) -> "LoopyBeliefPropagation":
+        """Build the factor graph for a set of factors."""
+
+        cards = {}
+        for factor in factors:
+            for variable, card in zip(factor.scope, factor.cards):
+                cards[int(variable)] = int(card)
+
+        self._variables = np.asarray(sorted(cards), dtype=np.int64)
+        self._cards = np.asarray([cards[x] for x in self._variables], dtype=np.int64)
+        self._positions = {int(x): i for i, x in enumerate(self._variables)}
+
+        self._scopes = [np.asarray(factor.scope, dtype=np.int64) for factor in factors]
+        self._tables = [
+            factor.parameters.reshape(*factor.cards).astype(np.float64)
+            for factor in factors
+        ]
+
+        links = [
+            (self._positions[int(variable)], node, axis)
+            for node, scope in enumerate(self._scopes)
+            for axis, variable in enumerate(scope)
+        ]
+        order = sorted(range(len(links)), key=lambda x: links[x][0])
+
+        self._edges = [np.zeros(len(scope), dtype=np.int64) for scope in self._scopes]
+        for edge, link in enumerate(order):
+            _, node, axis = links[link]
+            self._edges[node][axis] = edge
+
+        self._edge_variables = np.asarray([links[x][0] for x in order], dtype=np.int64)
+        self._edge_factors = np.asarray([links[x][1] for x in order], dtype=np.int64)
+        self._offsets = np.searchsorted(
+            self._edge_variables, np.arange(len(self._variables) + 1)
+        )
+
+        width = int(self._cards.max()) if len(self._cards) > 0 else 0
+        states = np.arange(width)
+        self._mask = states[None, :] < self._cards[self._edge_variables][:, None]
+
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for node, table in enumerate(self._tables):
+            groups.setdefault(table.shape, []).append(node)
+
+        self._groups = [
+            (
+                np.stack([self._edges[node] for node in nodes]),
+                np.stack([self._tables[node] for node in nodes]),
+            )
+            for nodes in groups.values()
+        ]
+
+        self.evidence = {}
+        self._unary = (states[None, :] < self._cards[:, None]).astype(np.float64)
+        self._stale = True
+
+        return self
+
+    def propagate(self, variables: Optional[List[int]] = None) -> None:
+        """
+        Pass messages until they converge, or the iteration cap is reached.
+
+        Messages are restarted from uniform after each change in evidence, so results
+        do not depend on the order of queries. Messages are not passed again until
+        the evidence changes.
+
+        Parameters
+        ----------
+        variables: list, optional
+            Accepted for compatibility with `JunctionTree`. Every message in the
+            graph is passed regardless.
+
+        """
+
+        if not self._stale:
+            return
+
+        self._messages = self._normalise(np.ones(self._mask.shape))
+
+        if self.mode == SYNCHRONOUS:
+            self._propagate_synchronous()
+        else:
+            self._propagate_residual()
+
+        self._stale = False
+
+    def _update_evidence(self, evidence: Dict[int, int]) -> None:
+        """Clamp the unary potentials of observed variables to their states."""
+
+        states = np.arange(self._unary.shape[1])
+        for variable in set(evidence) | set(self.evidence):
+            position = self._positions[variable]
+            card = self._cards[position]
+            if variable in evidence:
+                self._unary[position] = states == evidence[variable]
+            else:
+                self._unary[position] = states < card
+
+        self._stale = True
+
+    def marginals(self, *variables: Tuple[int]) -> FactorLike:
+        """Compute the (approximate) marginal distributions for some variables."""
+
+        self.propagate()
+
+        for variable in variables:
+            position = self._positions[variable]
+            card = int(self._cards[position])
+            start, stop = self._offsets[position], self._offsets[position + 1]
+
+            belief = self._unary[position, :card] * np.prod(
+                self._messages[start:stop, :card], axis=0
+            )
+            z = belief.sum()
+
+            yield DiscreteFactor(
+                np.asarray([variable]),
+                np.asarray([card]),
+                belief / z if z > 0 else belief,
+            )
+
+    def _propagate_synchronous(self) -> None:
+        """Update every message at once until the messages converge."""
+
+        self.converged = False
+        for iteration in range(1, self.max_iterations + 1):
+            update = self._factor_messages(self._variable_messages())
+            update = self._damp(update, self._messages)
+
+            residual = np.abs(update - self._messages).max(initial=0.0)
+            self._messages = update
+            self.iterations = iteration
+
+            if residual < self.tolerance:
+                self.converged = True
+                break
+
+    def _propagate_residual(self) -> None:
+        """Update the message with the largest residual until none exceeds tolerance."""
+
+        candidates = self._factor_messages(self._variable_messages())
+        residuals = np.abs(candidates - self._messages).max(axis=1, initial=0.0)
+
+        # entries are invalidated by later pushes for the same edge.
+        stamps = np.zeros(len(residuals), dtype=np.int64)
+        counter = count(1)
+        heap = []
+
+        def push(edge: int) -> None:
+            stamps[edge] = next(counter)
+            heappush(heap, (-residuals[edge], stamps[edge], edge))
+
+        for edge in range(len(residuals)):
+            push(edge)
+
+        limit = self.max_iterations * len(residuals)
+        updates = 0
+        self.converged = False
+
+        while updates < limit:
+            if len(heap) == 0 or -heap[0][0] < self.tolerance:
+                self.converged = True
+                break
+
+            _, stamp, edge = heappop(heap)
+            if stamp != stamps[edge]:
+                continue
+
+            message = self._damp(candidates[edge], self._messages[edge])
+            residuals[edge] = np.abs(candidates[edge] - message).max()
+            self._messages[edge] = message
+            updates += 1
+            push(edge)
+
+            # the variable's messages to its other factors have changed, and so have
+            # the messages from those factors to their other variables.
+            position = self._edge_variables[edge]
+            for other in range(self._offsets[position], self._offsets[position + 1]):
+                if other == edge:
+                    continue
+
+                node = self._edge_factors[other]
+                for axis, target in enumerate(self._edges[node]):
+                    if target == other:
+                        continue
+
+                    candidates[target] = self._factor_message(node, axis)
+                    residuals[target] = np.abs(
+                        candidates[target] - self._messages[target]
+                    ).max()
+                    push(target)
+
+        self.iterations = -(-updates // max(len(residuals), 1))
+
+    def _variable_messages(self) -> np.ndarray:
+        """Compute every variable-to-factor message from the current messages."""
+
+        # each message is the product of the variable's other incoming messages. This
+        # is the product of all of them divided by its own, taken in log space, with
+        # zeros counted separately so they can be divided out exactly.
+        positive = self._messages > 0
+        logs = np.log(np.where(positive, self._messages, 1.0))
+        zeros = (~positive).astype(np.int64)
+
+        logs = (
+            np.add.reduceat(logs, self._offsets[:-1], axis=0)[self._edge_variables]
+            - logs
+        )
+        zeros = (
+            np.add.reduceat(zeros, self._offsets[:-1], axis=0)[self._edge_variables]
+            - zeros
+        )
+
+        unary = self._unary[self._edge_variables]
+        logs = np.where((unary > 0) & (zeros == 0), logs, -np.inf)
+
+        shift = logs.max(axis=1, keepdims=True)
+        shift[~np.isfinite(shift)] = 0.0
+
+        return self._normalise(unary * np.exp(logs - shift))
+
+    def _factor_messages(self, incoming: np.ndarray) -> np.ndarray:
+        """Compute every factor-to-variable message, one group of factors at a time."""
+
+        messages = np.ones_like(self._messages)
+
+        for edges, tables in self._groups:
+            axes = np.arange(edges.shape[1])
+            for axis in axes:
+                table = tables
+                for other in axes[axes != axis]:
+                    card = tables.shape[1 + other]
+                    table = table * table_expand(
+                        incoming[edges[:, other], :card], [other], axes
+                    )
+
+                message, _ = table_marginalise(table, axes, [axis])
+                messages[edges[:, axis], : tables.shape[1 + axis]] = message
+
+        return self._normalise(messages)
+
+    def _factor_message(self, node: int, axis: int) -> np.ndarray:
+        """Compute a single factor-to-variable message from the current messages."""
+
+        table = self._tables[node]
+        axes = np.arange(table.ndim)
+
+        for other in axes[axes != axis]:
+            edge = self._edges[node][other]
+            position = self._edge_variables[edge]
+            card = table.shape[other]
+            start, stop = self._offsets[position], self._offsets[position + 1]
+
+            rows = np.arange(start, stop)
+            incoming = self._unary[position, :card] * np.prod(
+                self._messages[rows[rows != edge], :card], axis=0
+            )
+
+            shape = [1] * table.ndim
+            shape[other] = card
+            table = table * incoming.reshape(shape)
+
+        edge = self._edges[node][axis]
+        message = np.ones((1, self._messages.shape[1]))
+        message[0, : table.shape[axis]] = table.sum(axis=tuple(axes[axes != axis]))
+
+        return self._normalise(message, self._mask[edge : edge + 1])[0]
+
+    def _damp(self, update: np.ndarray, previous: np.ndarray) -> np.ndarray:
+        """Mix an updated message with its previous value."""
+
+        if self.damping == 0.0:
+            return update
+
+        return (1.0 - self.damping) * update + self.damping * previous
+
+    def _normalise(
+        self, messages: np.ndarray, mask: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Normalise each message over its valid states, padding with ones."""
+
+        mask = self._mask if mask is None else mask
+
+        messages = np.where(mask, messages, 0.0)
+        z = messages.sum(axis=1, keepdims=True)
+        messages = np.divide(messages, z, out=messages, where=z > 0)
+
+        return np.where(mask, messages, 1.0)
+
+    def __contains__(self, variable: int) -> bool:
+        """Check if a variable is in the scope of the graph."""
+
+        return variable in self._positions
+
+    @classmethod
+    def from_factors(
+        cls, factor_set: FactorSetLike, **kwargs: Optional[Any]
+    ) -> "LoopyBeliefPropagation":
+        """Create a factor graph from a provided FactorSet object."""
+
+        return cls(**kwargs).initialise(factor_set.factors)
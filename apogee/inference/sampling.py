@@ -0,0 +1,326 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import networkx as nx
+import numpy as np
+
+from apogee.factors import DiscreteFactor
+from apogee.utils.typing import FactorLike, FactorSetLike
+
+from .base import Engine
+
+
+class ForwardSampler:
+    """
+    Draw joint samples from a Bayesian network by ancestral (forward) sampling.
+
+    The factors must be conditional probability tables: the first variable in the
+    scope of each factor is the child, and the remaining variables are its parents.
+    Variables are sampled in topological order, a whole batch at a time.
+
+    Parents without a table of their own (as in the networks built by pruning a
+    query, see `DirectedModel.relevant`) are allowed, but must be observed.
+
+    Each table is stored with one row per assignment of its parents, as cumulative
+    probabilities offset by the row number. The flattened table is then sorted, so
+    a batch of children is drawn with a single `searchsorted` of 'row + u' for
+    uniform 'u', whatever the assignments of their parents.
+    """
+
+    def __init__(self, factors: List[FactorLike]):
+        """
+        Create a new ForwardSampler.
+
+        Parameters
+        ----------
+        factors: list
+            The conditional probability table of each variable in the network.
+
+        """
+
+        graph = nx.DiGraph()
+        tables = {}
+        for factor in factors:
+            child, parents = int(factor.scope[0]), [int(x) for x in factor.scope[1:]]
+            if child in tables:
+                raise ValueError(
+                    "Expected one table per variable, got several for {0}.".format(
+                        child
+                    )
+                )
+
+            tables[child] = factor
+            graph.add_node(child)
+            graph.add_edges_from((parent, child) for parent in parents)
+
+        try:
+            self.order = [int(x) for x in nx.topological_sort(graph)]
+        except nx.NetworkXUnfeasible:
+            raise ValueError("Cannot sample from a network with directed cycles.")
+
+        self.cards: Dict[int, int] = {}
+        for factor in factors:
+            for variable, card in zip(factor.scope[1:], factor.cards[1:]):
+                self.cards[int(variable)] = int(card)
+
+        self._parents: Dict[int, np.ndarray] = {}
+        self._parent_cards: Dict[int, np.ndarray] = {}
+        self._tables: Dict[int, np.ndarray] = {}
+        self._cumulative: Dict[int, np.ndarray] = {}
+
+        for variable in [x for x in self.order if x in tables]:
+            factor = tables[variable]
+            card = int(factor.cards[0])
+
+            # one row per parent assignment, and one column per state of the child.
+            table = factor.parameters.reshape(*factor.cards).astype(np.float64)
+            table = np.moveaxis(table, 0, -1).reshape(-1, card)
+
+            z = table.sum(axis=1, keepdims=True)
+            table = np.divide(
+                table, z, out=np.full_like(table, 1.0 / card), where=z > 0
+            )
+
+            cumulative = np.cumsum(table, axis=1)
+            cumulative[:, -1] = 1.0
+            cumulative += np.arange(len(table))[:, None]
+
+            self.cards[variable] = card
+            self._parents[variable] = np.asarray(factor.scope[1:], dtype=np.int64)
+            self._parent_cards[variable] = np.asarray(factor.cards[1:], dtype=np.int64)
+            self._tables[variable] = table
+            self._cumulative[variable] = cumulative.ravel()
+
+    def sample(
+        self, n: int, random_state: Optional[np.random.RandomState] = None
+    ) -> Dict[int, np.ndarray]:
+        """
+        Draw 'n' joint samples from the network.
+
+        Returns
+        -------
+        out: dict
+            A mapping of each variable to an integer array of its sampled states.
+
+        """
+
+        samples, _ = self.sample_weighted(n, {}, random_state=random_state)
+        return samples
+
+    def sample_weighted(
+        self,
+        n: int,
+        evidence: Dict[int, int],
+        random_state: Optional[np.random.RandomState] = None,
+    ) -> Tuple[Dict[int, np.ndarray], np.ndarray]:
+        """
+        Draw 'n' joint samples with observed variables fixed to their evidence.
+
+        This is likelihood weighting: each sample is weighted by the probability of
+        the evidence given the sampled states of its parents.
+
+        Returns
+        -------
+        out: tuple
+            A mapping of each variable to an integer array of its sampled states, and
+            an array of the log weight of each sample.
+
+        """
+
+        random_state = random_state or np.random
+
+        samples = {}
+        weights = np.zeros(n)
+
+        with np.errstate(divide="ignore"):
+            for variable in self.order:
+                if variable in evidence:
+                    state = int(evidence[variable])
+                    samples[variable] = np.full(n, state, dtype=np.int64)
+                    if variable in self._tables:
+                        rows = self._rows(variable, samples, n)
+                        weights += np.log(self._tables[variable][rows, state])
+                    continue
+
+                if variable not in self._tables:
+                    raise ValueError(
+                        "Variable {0} has no table, and must be observed.".format(
+                            variable
+                        )
+                    )
+
+                rows = self._rows(variable, samples, n)
+                card = self.cards[variable]
+                states = np.searchsorted(
+                    self._cumulative[variable],
+                    rows + random_state.random_sample(n),
+                    side="right",
+                )
+                samples[variable] = np.minimum(states - rows * card, card - 1)
+
+        return samples, weights
+
+    def _rows(
+        self, variable: int, samples: Dict[int, np.ndarray], n: int
+    ) -> np.ndarray:
+        """Get the table row of a variable for each sampled assignment of parents."""
+
+        parents = self._parents[variable]
+        if len(parents) == 0:
+            return np.zeros(n, dtype=np.int64)
+
+        return np.ravel_multi_index(
+            [samples[parent] for parent in parents], self._parent_cards[variable]
+        )
+
+    @classmethod
+    def from_factors(cls, factor_set: FactorSetLike) -> "ForwardSampler":
+        """Create a sampler from a provided FactorSet object."""
+
+        return cls(factor_set.factors)
+
+
+class LikelihoodWeighting(Engine):
+    """
+    Approximate inference in a Bayesian network by likelihood weighting.
+
+    Weighted samples are drawn with the evidence fixed (see `ForwardSampler`), and
+    marginals are estimated from weighted counts. Estimates are anytime: `draw`
+    refines them with further samples, without discarding those drawn already. The
+    cost of a query does not depend on the treewidth of the network, but estimates
+    degrade as the evidence becomes less likely, as fewer samples carry most of the
+    weight (see `effective_samples`).
+    """
+
+    def __init__(
+        self,
+        samples: int = 10000,
+        batch_size: int = 100000,
+        random_state: Optional[int] = None,
+    ):
+        """
+        Create a new LikelihoodWeighting instance.
+
+        Parameters
+        ----------
+        samples: int, optional
+            The number of samples drawn for each set of evidence.
+        batch_size: int, optional
+            The maximum number of samples drawn at once.
+        random_state: int, optional
+            A seed for the random number generator.
+
+        """
+
+        self.samples = samples
+        self.batch_size = batch_size
+        self.evidence: Dict[int, int] = {}
+        self._random = np.random.RandomState(random_state)
+        self._sampler: Optional[ForwardSampler] = None
+        self._reset()
+
+    def initialise(self, factors: List[FactorLike]) -> "LikelihoodWeighting":
+        """Build the sampler for a set of factors."""
+
+        self._sampler = ForwardSampler(factors)
+        self.evidence = {}
+        self._reset()
+
+        return self
+
+    def draw(self, n: int) -> None:
+        """Draw 'n' more weighted samples, refining the current estimates."""
+
+        for i in range(0, n, self.batch_size):
+            size = min(self.batch_size, n - i)
+            samples, weights = self._sampler.sample_weighted(
+                size, self.evidence, random_state=self._random
+            )
+
+            # weights are accumulated relative to the largest seen, so that they
+            # cannot all underflow under unlikely evidence.
+            shift = max(self._shift, weights.max())
+            if not np.isfinite(shift):
+                self._drawn += size
+                continue
+
+            scale = np.exp(self._shift - shift)
+            weights = np.exp(weights - shift)
+
+            for variable, states in samples.items():
+                self._counts[variable] = self._counts[variable] * scale + np.bincount(
+                    states, weights=weights, minlength=self._sampler.cards[variable]
+                )
+
+            self._total = self._total * scale + weights.sum()
+            self._squares = self._squares * scale**2 + (weights**2).sum()
+            self._shift = shift
+            self._drawn += size
+
+    def propagate(self, variables: Optional[List[int]] = None) -> None:
+        """Draw samples until 'samples' have been drawn for the current evidence."""
+
+        if self._drawn < self.samples:
+            self.draw(self.samples - self._drawn)
+
+    def _update_evidence(self, evidence: Dict[int, int]) -> None:
+        """Discard the samples drawn for the current evidence."""
+
+        self._reset()
+
+    def marginals(self, *variables: Tuple[int]) -> FactorLike:
+        """Estimate the marginal distributions for a collection of variables."""
+
+        self.propagate()
+
+        for variable in variables:
+            counts = self._counts[variable]
+            yield DiscreteFactor(
+                np.asarray([variable]),
+                np.asarray([len(counts)]),
+                counts / self._total if self._total > 0 else counts,
+            )
+
+    def log_evidence(self) -> float:
+        """Estimate the log probability of the evidence, log P(e)."""
+
+        self.propagate()
+
+        if self._total == 0:
+            return -np.inf
+
+        return float(np.log(self._total) + self._shift - np.log(self._drawn))
+
+    @property
+    def effective_samples(self) -> float:
+        """Get the effective sample size of the weighted samples drawn so far."""
+
+        return float(self._total**2 / self._squares) if self._squares > 0 else 0.0
+
+    def _reset(self) -> None:
+        """Discard the samples drawn so far."""
+
+        cards = self._sampler.cards if self._sampler is not None else {}
+        self._counts = {variable: np.zeros(card) for variable, card in cards.items()}
+        self._total = 0.0
+        self._squares = 0.0
+        self._shift = -np.inf
+        self._drawn = 0
+
+    def __contains__(self, variable: int) -> bool:
+        """Check if a variable is in the scope of the sampler."""
+
+        return self._sampler is not None and variable in self._sampler.cards
+
+    @classmethod
+    def from_factors(
+        cls, factor_set: FactorSetLike, **kwargs: Optional[Any]
+    ) -> "LikelihoodWeighting":
+        """Create a sampler from a provided FactorSet object."""
+
+        return cls(**kwargs).initialise(factor_set.factors)
@@ -4,8 +4,10 @@ The MIT License
 Copyright (c) 2017-2020 Mark Douthwaite
 """
 
+from . import arrays
 from .parsers import hugin
 
 __all__ = [
+    "arrays",
     "hugin"
 ]
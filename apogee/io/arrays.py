@@ -0,0 +1,83 @@
+"""
+The MIT License
+
+Copyright (c) 2017-2020 Mark Douthwaite
+"""
+
+import struct
+import zipfile
+from io import BytesIO
+from typing import Dict, Text
+
+import numpy as np
+
+
+def save(filename: Text, **arrays: np.ndarray) -> None:
+    """Save a collection of named arrays to an (uncompressed) '.npz' archive."""
+
+    with open(filename, "wb") as file:
+        np.savez(file, **arrays)
+
+
+def load(filename: Text, mmap: bool = True) -> Dict[Text, np.ndarray]:
+    """
+    Load a collection of named arrays from an '.npz' archive.
+
+    NumPy always reads '.npz' members into memory. As members of an uncompressed
+    archive are stored contiguously, each can instead be memory-mapped directly
+    from the archive by locating its data within the file.
+
+    Parameters
+    ----------
+    filename: str
+        The path to an archive written by `save` (or `numpy.savez`).
+    mmap: bool, optional
+        If True (the default), arrays are memory-mapped read-only. Scalar and empty
+        arrays are always read into memory.
+
+    Returns
+    -------
+    out: dict
+        A mapping of names to arrays.
+
+    """
+
+    if not mmap:
+        with np.load(filename) as data:
+            return {name: data[name] for name in data.files}
+
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, "rb") as file:
+        for info in archive.infolist():
+            name = info.filename[: -len(".npy")]
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(
+                    "Cannot memory-map compressed array '{0}'.".format(name)
+                )
+
+            # the member's data follows its local header, file name and extra field.
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", file.read(4))
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(file)
+
+            if len(shape) == 0 or int(np.prod(shape)) == 0 or dtype.hasobject:
+                arrays[name] = np.load(BytesIO(archive.read(info)))
+                continue
+
+            arrays[name] = np.memmap(
+                filename,
+                dtype=dtype,
+                mode="r",
+                offset=file.tell(),
+                shape=shape,
+                order="F" if fortran else "C",
+            )
+
+    return arrays
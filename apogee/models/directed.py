@@ -4,20 +4,169 @@ The MIT License
 Copyright (c) 2017-2020 Mark Douthwaite
 """
 
+from collections import OrderedDict
+from typing import Generator, Iterable, List, Optional, Any, Set
+
+import numpy as np
 from networkx import DiGraph
+from pandas import Categorical, DataFrame, concat
 from .undirected import UndirectedModel
+from apogee.factors import FactorSet
+from apogee.inference import ForwardSampler, JunctionTree
 from apogee.models.variables import DiscreteVariable
 
 
 class DirectedModel(UndirectedModel):
-    def __init__(self):
-        super().__init__()
+    def __init__(
+        self, *args: Optional[Any], prune: bool = False, **kwargs: Optional[Any]
+    ):
+        """
+        Create a new DirectedModel instance.
+
+        Accepts the same arguments as `UndirectedModel`, and:
+
+        Parameters
+        ----------
+        prune: bool, optional
+            If True, each query is answered by an engine compiled over only the
+            variables relevant to it (see `relevant`). Engines are cached by their
+            relevant set, so repeated query shapes are compiled once.
+
+        """
+
+        super().__init__(*args, **kwargs)
+        self.prune = prune
         self._graph = DiGraph()
+        self._engines: OrderedDict = OrderedDict()
+
+    def relevant(
+        self, targets: Iterable[str], observed: Iterable[str] = ()
+    ) -> Set[str]:
+        """
+        Find the variables whose CPTs are required to compute P(targets | observed).
+
+        This is the 'Bayes-ball' algorithm [1]. Barren variables (unobserved
+        variables with no queried or observed descendants) and variables d-separated
+        from the targets by the evidence are excluded. Observed parents of relevant
+        variables are not themselves relevant: they enter the query as evidence only.
+
+        References
+        ----------
+        [1] Bayes-Ball: The Rational Pastime, R. Shachter (UAI 1998)
+
+        """
+
+        observed = set(observed) - set(targets)
+        top, bottom = set(), set()
+
+        # each visit is a (variable, reached-from-a-child) pair.
+        schedule = [(name, True) for name in targets]
+        while len(schedule) > 0:
+            name, from_child = schedule.pop()
+
+            if name not in observed and from_child:
+                if name not in top:
+                    top.add(name)
+                    schedule.extend((x, True) for x in self._graph.predecessors(name))
+                if name not in bottom:
+                    bottom.add(name)
+                    schedule.extend((x, False) for x in self._graph.successors(name))
+
+            elif not from_child:
+                if name in observed and name not in top:
+                    top.add(name)
+                    schedule.extend((x, True) for x in self._graph.predecessors(name))
+                if name not in observed and name not in bottom:
+                    bottom.add(name)
+                    schedule.extend((x, False) for x in self._graph.successors(name))
+
+        return top
+
+    def iter_sample(
+        self, n: int, batch_size: int = 100000, random_state: Optional[int] = None
+    ) -> Generator[DataFrame, None, None]:
+        """
+        Draw joint samples from the model by forward sampling, a batch at a time.
+
+        Parameters
+        ----------
+        n: int
+            The number of samples to draw.
+        batch_size: int, optional
+            The maximum number of samples drawn (and yielded) at once.
+        random_state: int, optional
+            A seed for the random number generator.
+
+        Yields
+        ------
+        out: DataFrame
+            A frame with a categorical column of sampled states for each variable.
+
+        """
+
+        sampler = ForwardSampler.from_factors(FactorSet(*self.factors))
+        random_state = np.random.RandomState(random_state)
+
+        for i in range(0, n, batch_size):
+            samples = sampler.sample(min(batch_size, n - i), random_state=random_state)
+            yield DataFrame(
+                {
+                    name: Categorical.from_codes(
+                        samples[index], categories=variable.states
+                    )
+                    for index, (name, variable) in enumerate(self.variables.items())
+                }
+            )
+
+    def sample(self, n: int, **kwargs: Optional[Any]) -> DataFrame:
+        """Draw joint samples from the model. See `iter_sample` for arguments."""
+
+        return concat(self.iter_sample(n, **kwargs), ignore_index=True)
+
+    def _select(
+        self, variables: List[int] = None, observed: List[int] = ()
+    ) -> JunctionTree:
+        """Get (or compile) an engine over the variables relevant to a query."""
+
+        if not self.prune or variables is None:
+            return self.engine
+
+        names = self.relevant(
+            [self.name(i) for i in variables], [self.name(i) for i in observed]
+        )
+
+        # queries with nothing relevant (no targets) need no pruned engine either.
+        if len(names) == 0 or len(names) == len(self.variables):
+            return self.engine
+
+        key = frozenset(names)
+        if key not in self._engines:
+            if len(self._engines) >= 128:
+                _, engine = self._engines.popitem(last=False)
+                engine.close()
+
+            self._engines[key] = self._build(
+                FactorSet(*[self.variables[name].factor for name in names])
+            )
+
+        self._engines.move_to_end(key)
+
+        return self._engines[key]
+
+    def _invalidate(self) -> None:
+        """Discard the compiled engines and any cached predictions."""
+
+        super()._invalidate()
+
+        for engine in self._engines.values():
+            engine.close()
+
+        self._engines = OrderedDict()
 
     @classmethod
-    def from_dict(cls, data: dict):
+    def from_dict(cls, data: dict, **kwargs: Optional[Any]):
 
-        model = cls()
+        model = cls(**kwargs)
 
         for key, value in data.items():
             if "type" in value:
@@ -4,17 +4,28 @@ The MIT License
 Copyright (c) 2017-2020 Mark Douthwaite
 """
 
+import hashlib
 import json
-from typing import List, Generator, Optional, Any, Text
+import os
+import warnings
+from typing import List, Generator, Optional, Any, Dict, Text, Tuple
 from collections import OrderedDict
 
 from functools import lru_cache
 
-from pandas import DataFrame
+import numpy as np
+from pandas import Categorical, DataFrame, MultiIndex, Series, concat
 from networkx import Graph
 
 from apogee import io
-from apogee.inference import JunctionTree
+from apogee.inference import (
+    BatchExecutor,
+    CutsetConditioning,
+    GibbsSampler,
+    JunctionTree,
+    LikelihoodWeighting,
+    LoopyBeliefPropagation,
+)
 from apogee.factors import FactorSet
 from apogee.models.variables import DiscreteVariable
 
@@ -26,15 +37,64 @@ class UndirectedModel:
     An interface for building undirected graphical models.
     """
 
-    _var_types = {
-        "discrete": DiscreteVariable
+    _var_types = {"discrete": DiscreteVariable}
+
+    _engine_types = {
+        "junction-tree": JunctionTree,
+        "loopy": LoopyBeliefPropagation,
+        "likelihood-weighting": LikelihoodWeighting,
+        "gibbs": GibbsSampler,
+        "cutset": CutsetConditioning,
     }
 
-    def __init__(self):
-        """Create a new GraphicalModel instance."""
+    def __init__(
+        self,
+        propagation: str = "shafer-shenoy",
+        workers: int = None,
+        inference: str = "junction-tree",
+        options: Optional[dict] = None,
+    ):
+        """
+        Create a new GraphicalModel instance.
+
+        Parameters
+        ----------
+        propagation: str, optional
+            The propagation scheme used by the compiled junction tree. One of
+            'shafer-shenoy' (the default) or 'hugin'.
+        workers: int, optional
+            The number of threads used to send independent messages concurrently in
+            the compiled junction tree. By default, messages are sent sequentially.
+        inference: str, optional
+            The inference engine. One of 'junction-tree' (the default, exact), 'loopy'
+            (see `LoopyBeliefPropagation`), 'likelihood-weighting' (directed models
+            only, see `LikelihoodWeighting`), 'gibbs' (see `GibbsSampler`) or
+            'cutset' (exact within a memory budget, see `CutsetConditioning`). These
+            engines support marginal queries (`predict`) only.
+        options: dict, optional
+            Keyword arguments for the engine, for example the 'mode' and 'damping' of
+            the 'loopy' engine, the number of 'samples' drawn by the
+            'likelihood-weighting' engine, or the 'max_bytes' of the 'cutset' engine.
+
+        """
+
+        if inference not in self._engine_types:
+            raise ValueError("Unknown inference engine '{0}'.".format(inference))
+
+        self.propagation = propagation
+        self.workers = workers
+        self.inference = inference
+        self.options = options or {}
         self._graph = Graph()
+        self._engine: Optional[JunctionTree] = None
         self.variables: OrderedDict = OrderedDict()
 
+        # lookups between names and indices of variables, and names and indices of
+        # their states, maintained by `add` and `remove`.
+        self._indices: Dict[str, int] = {}
+        self._names: List[str] = []
+        self._states: Dict[str, Dict[str, int]] = {}
+
     def add(self, variable: VariableLike) -> "GraphicalModel":
         """Add a variable to the model."""
 
@@ -43,34 +103,250 @@ class UndirectedModel:
         for other in variable.neighbours:
             self._graph.add_edge(other, variable.name)
 
+        # replacing a variable keeps its index.
+        if variable.name not in self._indices:
+            self._indices[variable.name] = len(self._names)
+            self._names.append(variable.name)
+
+        self._states[variable.name] = {
+            state: i for i, state in enumerate(getattr(variable, "states", []))
+        }
+
+        self._invalidate()
+
         return self
 
     def remove(self, name: str) -> "GraphicalModel":
         """Remove a variable from the model."""
 
         del self.variables[name]
+        self._graph.remove_node(name)
+
+        # variables after the one removed each move down an index.
+        del self._states[name]
+        self._names.remove(name)
+        self._indices = {key: i for i, key in enumerate(self._names)}
+
+        self._invalidate()
+
+        return self
+
+    def compile(
+        self,
+        cache: Optional[Text] = None,
+        max_bytes: Optional[int] = None,
+        fallback: bool = False,
+    ) -> "GraphicalModel":
+        """
+        Compile the inference engine for the model.
+
+        The structure and initial potentials of the engine are built once and reused
+        by every subsequent query. Calling `fit`, `add` or `remove` discards the
+        compiled engine, and it will be rebuilt on the next query.
+
+        Parameters
+        ----------
+        cache: str, optional
+            The path to an '.npz' archive of a compiled model (see `save`). If the
+            archive was saved from a model with the same checksum, its engine is
+            loaded (memory-mapped) instead of being compiled. Otherwise, the model is
+            compiled and saved to the path. Only junction tree engines are cached.
+        max_bytes: int, optional
+            A ceiling on the estimated size of the engine's tables (see
+            `complexity`). If the estimate exceeds it, a ValueError is raised before
+            any tables are allocated. Engines loaded from 'cache' are checked too.
+        fallback: bool, optional
+            If True, a model exceeding 'max_bytes' is compiled to an approximate
+            'loopy' engine instead of raising a ValueError, and a warning is issued.
+            Queries requiring a junction tree (such as `mpe` or `score`) then raise
+            a ValueError.
+
+        Returns
+        -------
+        out: GraphicalModel
+            The compiled model.
+
+        """
+
+        cached = self.inference == "junction-tree" and cache is not None
+
+        # the engine being replaced may hold worker threads or processes.
+        if self._engine is not None:
+            self._engine.close()
+
+        if cached and os.path.exists(cache):
+            arrays = io.arrays.load(cache)
+            if str(arrays["checksum"]) == self.checksum():
+                engine = JunctionTree.from_arrays(
+                    arrays, propagation=self.propagation, workers=self.workers
+                )
+
+                # a cached engine over the budget is treated as a cache miss.
+                if max_bytes is None or engine.table_bytes <= max_bytes:
+                    self._engine = engine
+                    return self
+
+        self._engine = self._build(FactorSet(*self.factors), max_bytes, fallback)
+
+        if cached and isinstance(self._engine, JunctionTree):
+            self.save(cache)
 
         return self
 
+    def _build(
+        self,
+        factor_set: FactorSet,
+        max_bytes: Optional[int] = None,
+        fallback: bool = False,
+    ) -> Any:
+        """Build the configured inference engine over a set of factors."""
+
+        inference = self.inference
+        if inference == "junction-tree" and fallback and max_bytes is not None:
+            required = JunctionTree.complexity(factor_set)["table_bytes"]
+            if required > max_bytes:
+                warnings.warn(
+                    "The junction tree needs {0} bytes, over the limit of {1}: falling "
+                    "back to approximate 'loopy' inference.".format(required, max_bytes)
+                )
+                inference, max_bytes = "loopy", None
+
+        if inference != "junction-tree":
+            engine = self._engine_types[inference]
+            return engine.from_factors(factor_set, **self.options)
+
+        return JunctionTree.from_factors(
+            factor_set,
+            max_bytes=max_bytes,
+            propagation=self.propagation,
+            workers=self.workers,
+        )
+
+    def complexity(self) -> Dict[str, int]:
+        """
+        Estimate the cost of compiling the model, without allocating any tables.
+
+        Returns
+        -------
+        out: dict
+            The number of cliques, the treewidth, the number of states in the
+            largest clique, the total size in bytes of the engine's tables and a
+            rough count of the floating point operations used by a full
+            propagation.
+
+        Examples
+        --------
+        >>> model.complexity()
+        {'cliques': 6, 'treewidth': 2, 'max_clique_states': 8, ...}
+
+        """
+
+        return JunctionTree.complexity(FactorSet(*self.factors))
+
+    def checksum(self) -> str:
+        """Get a hash of the structure and parameters of the model."""
+
+        data = json.dumps(self.to_dict(), sort_keys=True).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def to_dict(self) -> dict:
+        """Get the model in the format accepted by `from_dict`."""
+
+        data = OrderedDict()
+        for name, variable in self.variables.items():
+            value = variable.to_dict()[name]
+            if value["parameters"] is not None:
+                value["parameters"] = np.asarray(value["parameters"]).tolist()
+            data[name] = dict(value, type=variable.flavour)
+
+        return data
+
+    def save(self, filename: Text) -> None:
+        """
+        Save the model and its compiled engine to an '.npz' archive.
+
+        The archive holds the model's variables (their names, states, neighbours and
+        parameters), its checksum and the arrays of the compiled junction tree, so
+        `load` can restore the model without parsing or compiling it. Only models
+        compiled to a junction tree can be saved.
+        """
+
+        engine = self._exact(self.engine, "save a model")
+
+        io.arrays.save(
+            filename,
+            checksum=np.asarray(self.checksum()),
+            model=np.asarray(json.dumps(self.to_dict())),
+            **engine.to_arrays(),
+        )
+
+    @classmethod
+    def load(
+        cls, filename: Text, mmap: bool = True, **kwargs: Optional[Any]
+    ) -> "GraphicalModel":
+        """
+        Load a model and its compiled engine from an '.npz' archive.
+
+        Parameters
+        ----------
+        filename: str
+            The path to an archive created by `save`.
+        mmap: bool, optional
+            If True (the default), the potentials of the engine are memory-mapped.
+        kwargs:
+            Keyword arguments passed to the model's constructor.
+
+        """
+
+        arrays = io.arrays.load(filename, mmap=mmap)
+
+        model = cls.from_dict(json.loads(str(arrays["model"])), **kwargs)
+        model._engine = JunctionTree.from_arrays(
+            arrays, propagation=model.propagation, workers=model.workers
+        )
+
+        return model
+
+    @property
+    def compiled(self) -> bool:
+        """Check if the model has a compiled inference engine."""
+
+        return self._engine is not None
+
+    @property
+    def engine(self) -> JunctionTree:
+        """Get the compiled inference engine, compiling the model if required."""
+
+        if self._engine is None:
+            self.compile()
+
+        return self._engine
+
     def index(self, name: str) -> int:
         """Get the index of the variable with the given name."""
 
-        # this is slow.
-        for i, key in enumerate(self.variables.keys()):
-            if key == name:
-                return i
-
-        raise KeyError(f"Name '{name}' not found.")
+        try:
+            return self._indices[name]
+        except KeyError:
+            raise KeyError(f"Name '{name}' not found.")
 
     def name(self, index: int) -> str:
         """Get the name of the variable at the given index."""
 
-        # this is slow.
-        for i, key in enumerate(self.variables.keys()):
-            if i == index:
-                return key
+        if not 0 <= index < len(self._names):
+            raise IndexError(f"Index '{index}' not found.")
 
-        raise IndexError(f"Index '{index}' not found.")
+        return self._names[index]
+
+    def state(self, name: str, value: str) -> int:
+        """Get the index of a state of the variable with the given name."""
+
+        try:
+            return self._states[name][value]
+        except KeyError:
+            raise ValueError(
+                "Unknown state for variable '{0}': {1}.".format(name, value)
+            )
 
     def fit(self, df: DataFrame) -> "GraphicalModel":
         """
@@ -97,6 +373,8 @@ class UndirectedModel:
         for name, variable in self.variables.items():
             variable.fit(df[variable.scope].values)
 
+        self._invalidate()
+
         return self
 
     def iter_predict(
@@ -126,24 +404,12 @@ class UndirectedModel:
 
         """
 
-        factors = FactorSet(*self.factors)
-
-        engine = JunctionTree.from_factors(factors)
-
-        if x is not None:
-            evidence = []
-            for key, value in x:
-                evidence.append([self.index(key), self[key].states.index(value)])
-
-            engine.update_observations(evidence)
-
-        engine.propagate()
-        engine.calibrate()
-
         if marginals is not None:
-            v = [v for v in factors.vars if self.name(v) in marginals]
+            v = sorted(self._indices[name] for name in marginals if name in self)
         else:
-            v = factors.vars
+            v = range(len(self.variables))
+
+        engine = self._observe(x, variables=v)
 
         for marginal in engine.marginals(*v):
             response = {}
@@ -156,6 +422,339 @@ class UndirectedModel:
 
             yield {name: response}
 
+    def iter_predict_batch(
+        self,
+        df: DataFrame,
+        marginals: tuple = None,
+        batch_size: int = 10000,
+        processes: int = None,
+    ) -> Generator[DataFrame, None, None]:
+        """
+        Yields marginals for many evidence sets, one batch of rows at a time.
+
+        Parameters
+        ----------
+        df: DataFrame
+            A dataframe of evidence, with one row per query. Each column should
+            correspond to a variable in the model, and contain state names. Missing
+            values (NaN) indicate that a variable is unobserved in that row.
+        marginals: tuple, optional
+            A tuple containing the names of the variables you wish to obtain marginals
+            for. By default, marginals for all variables will be returned.
+        batch_size: int, optional
+            The maximum number of rows propagated through the engine at once.
+        processes: int, optional
+            If set, batches are propagated on a pool of this many worker processes
+            sharing the compiled potentials (see `apogee.inference.BatchExecutor`).
+            Batches are still yielded in order.
+
+        Yields
+        ------
+        out: DataFrame
+            A dataframe with one row per row in the batch, and a column for each
+            (variable, state) pair containing the marginal probability of that state.
+
+        """
+
+        names = list(marginals) if marginals is not None else list(self.variables)
+        indices = [self.index(name) for name in names]
+        evidence = self._encode_frame(df)
+
+        # columns missing in some rows are queried, rather than observed, when the
+        # engine is selected: their evidence is only entered where it is present.
+        observed = [k for k, v in evidence.items() if np.all(v >= 0)]
+        missing = [k for k in evidence if k not in observed]
+
+        engine = self._select(indices + missing, observed)
+        engine = self._exact(engine, "predict batches")
+        evidence = {k: v for k, v in evidence.items() if k in engine}
+
+        columns = MultiIndex.from_tuples(
+            [(name, state) for name in names for state in self.variables[name].states]
+        )
+        starts = range(0, len(df), batch_size)
+
+        if processes is None or len(evidence) == 0:
+            executor = None
+            results = (
+                engine.propagate_batch(
+                    {k: v[i : i + batch_size] for k, v in evidence.items()},
+                    variables=indices,
+                )
+                for i in starts
+            )
+        else:
+            executor = BatchExecutor(engine, processes=processes, chunk_size=batch_size)
+            results = executor.map(evidence, variables=indices)
+
+        try:
+            for start, result in zip(starts, results):
+                stop = min(start + batch_size, len(df))
+                block = np.hstack(
+                    [
+                        np.broadcast_to(result[i], (stop - start, result[i].shape[1]))
+                        for i in indices
+                    ]
+                )
+                yield DataFrame(block, index=df.index[start:stop], columns=columns)
+
+        finally:
+            if executor is not None:
+                executor.close()
+
+    def predict_batch(self, df: DataFrame, **kwargs: Optional[Any]) -> DataFrame:
+        """
+        Compute marginals for many evidence sets at once.
+
+        Accepts the same arguments as `iter_predict_batch`, and returns a single
+        dataframe with one row per row in 'df'.
+        """
+
+        frames = list(self.iter_predict_batch(df, **kwargs))
+
+        if len(frames) == 0:
+            names = kwargs.get("marginals") or list(self.variables)
+            columns = MultiIndex.from_tuples(
+                [(name, s) for name in names for s in self.variables[name].states]
+            )
+            return DataFrame(columns=columns, index=df.index, dtype=np.float32)
+
+        return concat(frames)
+
+    def _encode_frame(self, df: DataFrame) -> dict:
+        """Encode a dataframe of named evidence as arrays of state indices."""
+
+        evidence = {}
+        for name in df.columns:
+            states = self.variables[name].states
+            codes = Categorical(df[name], categories=states).codes.astype(np.int64)
+
+            unknown = (codes < 0) & df[name].notna().values
+            if np.any(unknown):
+                raise ValueError(
+                    "Unknown state(s) for variable '{0}': {1}.".format(
+                        name, ", ".join(str(x) for x in df[name][unknown].unique())
+                    )
+                )
+
+            evidence[self.index(name)] = codes
+
+        return evidence
+
+    def joint(self, variables: tuple, x: tuple = None) -> dict:
+        """
+        Compute the joint distribution over a collection of variables.
+
+        Parameters
+        ----------
+        variables: tuple
+            A tuple containing the names of the variables in the joint distribution.
+            The variables do not need to share a clique in the compiled model.
+        x: tuple, optional
+            Evidence, in the same format accepted by `iter_predict`.
+
+        Returns
+        -------
+        out: dict
+            A dictionary mapping tuples of state names (ordered as in 'variables') to
+            the joint probability of those states.
+
+        """
+
+        indices = [self.index(name) for name in variables]
+        engine = self._exact(self._observe(x, variables=indices), "compute a joint")
+        joint = engine.joint(*indices).normalise(row_wise=False)
+
+        mapping = [list(joint.scope).index(i) for i in indices]
+
+        response = {}
+        for assignment, p in zip(joint.assignments, joint.parameters):
+            states = tuple(
+                self.variables[name].states[assignment[j]]
+                for name, j in zip(variables, mapping)
+            )
+            response[states] = p
+
+        return response
+
+    def mpe(self, x: tuple = None) -> dict:
+        """
+        Compute the most probable explanation (MPE) for the model.
+
+        Parameters
+        ----------
+        x: tuple, optional
+            Evidence, in the same format accepted by `iter_predict`.
+
+        Returns
+        -------
+        out: dict
+            A dictionary mapping the name of each variable in the model to the name
+            of its state in the most probable joint assignment.
+
+        """
+
+        engine = self._exact(self.engine, "compute an MPE")
+        engine.set_observations(self._encode(x))
+
+        assignment, _ = engine.mpe()
+
+        return self._decode(assignment)
+
+    def top_k(self, k: int, x: tuple = None) -> List[Tuple[dict, float]]:
+        """
+        Compute the 'k' most probable explanations for the model.
+
+        Parameters
+        ----------
+        k: int
+            The number of explanations to return.
+        x: tuple, optional
+            Evidence, in the same format accepted by `iter_predict`.
+
+        Returns
+        -------
+        out: list
+            A list of up to 'k' tuples in decreasing order of probability. The first
+            element of each tuple maps the name of each variable to a state name, and
+            the second is the log joint probability of that assignment (including the
+            evidence) under the model.
+
+        """
+
+        engine = self._exact(self.engine, "compute explanations")
+        engine.set_observations(self._encode(x))
+
+        return [(self._decode(a), p) for a, p in engine.top_k(k)]
+
+    def log_likelihood(self, x: tuple = None) -> float:
+        """
+        Compute the log probability of some evidence under the model, log P(x).
+
+        Parameters
+        ----------
+        x: tuple, optional
+            Evidence, in the same format accepted by `iter_predict`.
+
+        Returns
+        -------
+        out: float
+            The log probability of the evidence.
+
+        """
+
+        evidence = self._encode(x)
+        engine = self._select([variable for variable, _ in evidence])
+        engine = self._exact(engine, "compute a log likelihood")
+        engine.set_observations(evidence)
+
+        return engine.log_evidence()
+
+    def score(self, df: DataFrame, batch_size: int = 10000) -> Series:
+        """
+        Compute the log probability of each row of evidence in a dataframe.
+
+        Rows observing every variable in the model are scored directly from the
+        variables' conditional probability tables, without running inference. All
+        other rows are scored in batches with a single collect pass per batch.
+
+        Parameters
+        ----------
+        df: DataFrame
+            A dataframe of evidence, in the same format accepted by `predict_batch`.
+        batch_size: int, optional
+            The maximum number of rows propagated through the engine at once.
+
+        Returns
+        -------
+        out: Series
+            The log probability of the evidence in each row of 'df'.
+
+        """
+
+        evidence = self._encode_frame(df)
+        scores = np.zeros(len(df))
+
+        complete = np.zeros(len(df), dtype=bool)
+        if len(evidence) == len(self.variables):
+            complete = np.all([codes >= 0 for codes in evidence.values()], axis=0)
+            scores[complete] = self._score_complete(
+                {k: v[complete] for k, v in evidence.items()}
+            )
+
+        rows = np.flatnonzero(~complete)
+        engine = self._exact(self._select(list(evidence)), "score batches")
+        evidence = {k: v[rows] for k, v in evidence.items() if k in engine}
+
+        for i in range(0, len(rows), batch_size):
+            batch = {k: v[i : i + batch_size] for k, v in evidence.items()}
+            scores[rows[i : i + batch_size]] = engine.log_evidence_batch(batch)
+
+        return Series(scores, index=df.index)
+
+    def _score_complete(self, evidence: dict) -> np.ndarray:
+        """Sum the log probability tables of each variable for observed rows."""
+
+        scores = 0.0
+        with np.errstate(divide="ignore"):
+            for variable in self.variables.values():
+                factor = variable.factor
+                index = np.ravel_multi_index(
+                    [evidence[i] for i in factor.scope], factor.cards
+                )
+                scores = scores + np.log(factor.parameters[index])
+
+        return scores
+
+    def _decode(self, assignment: dict) -> dict:
+        """Decode an assignment of variable and state indices to names."""
+
+        return {
+            self.name(i): self.variables[self.name(i)].states[state]
+            for i, state in sorted(assignment.items())
+        }
+
+    def _encode(self, x: tuple = None) -> List[List[int]]:
+        """Encode named evidence as a list of variable and state indices."""
+
+        evidence = []
+        if x is not None:
+            for key, value in x:
+                evidence.append([self.index(key), self.state(key, value)])
+
+        return evidence
+
+    def _select(
+        self, variables: List[int] = None, observed: List[int] = ()
+    ) -> JunctionTree:
+        """Get the engine used to query 'variables' given evidence on 'observed'."""
+
+        return self.engine
+
+    @staticmethod
+    def _exact(engine: Any, query: str) -> JunctionTree:
+        """Check that an engine is a junction tree, as required by some queries."""
+
+        if not isinstance(engine, JunctionTree):
+            raise ValueError(
+                "Cannot {0} with a {1} engine: only junction tree engines support "
+                "this query.".format(query, type(engine).__name__)
+            )
+
+        return engine
+
+    def _observe(self, x: tuple = None, variables: List[int] = None) -> JunctionTree:
+        """Enter evidence and calibrate the trees hosting 'variables' (or all)."""
+
+        evidence = self._encode(x)
+        engine = self._select(variables, [variable for variable, _ in evidence])
+        engine.set_observations([[k, v] for k, v in evidence if k in engine])
+
+        engine.propagate(variables)
+        engine.calibrate(variables)
+
+        return engine
+
     @castarg(name="x", argtype=tuple)
     @castarg(name="marginals", argtype=tuple)
     @lru_cache(256)
@@ -168,6 +767,15 @@ class UndirectedModel:
 
         return data
 
+    def _invalidate(self) -> None:
+        """Discard the compiled engine and any cached predictions."""
+
+        if self._engine is not None:
+            self._engine.close()
+
+        self._engine = None
+        UndirectedModel.predict.__wrapped__.__wrapped__.cache_clear()
+
     @property
     def factors(self) -> List[FactorLike]:
         """Get a list of the factors in the model."""
@@ -175,9 +783,9 @@ class UndirectedModel:
         return [x.factor for x in self.variables.values()]
 
     @classmethod
-    def from_dict(cls, data: dict):
+    def from_dict(cls, data: dict, **kwargs: Optional[Any]):
 
-        model = cls()
+        model = cls(**kwargs)
 
         for key, value in data.items():
             if "type" in value:
@@ -191,14 +799,19 @@ class UndirectedModel:
         return model
 
     @classmethod
-    def from_hugin(cls, filename: Text) -> "GraphicalModel":
+    def from_hugin(cls, filename: Text, **kwargs: Optional[Any]) -> "GraphicalModel":
         data: dict = io.hugin.load(open(filename))
-        return cls.from_dict(data)
+        return cls.from_dict(data, **kwargs)
 
     @classmethod
-    def from_json(cls, filename: Text) -> "GraphicalModel":
+    def from_json(cls, filename: Text, **kwargs: Optional[Any]) -> "GraphicalModel":
         data: dict = json.load(open(filename))
-        return cls.from_dict(data)
+        return cls.from_dict(data, **kwargs)
+
+    def __contains__(self, item: str) -> bool:
+        """Check if the model has a variable with label 'item'."""
+
+        return item in self._indices
 
     def __getitem__(self, item: str) -> VariableLike:
         """Return variable with label 'item'."""
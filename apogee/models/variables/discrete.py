@@ -83,18 +83,8 @@ class DiscreteVariable(variables.BaseVariable):
             )
 
         else:
-            scope = asarray(
-                [
-                    self.graph.index(self.name),
-                    *[self.graph.index(x) for x in self.neighbours or []],
-                ]
-            )
-            cards = asarray(
-                [
-                    len(self.states),
-                    *[len(self.graph[x].states) for x in self.neighbours or []],
-                ]
-            )
+            scope = self.iscope
+            cards = self.icards
             parameters = (
                 asarray(self.parameters, dtype=float32).flatten("F")
                 if self.parameters is not None
@@ -4,6 +4,7 @@ The MIT License
 Copyright (c) 2017-2020 Mark Douthwaite
 """
 
+from functools import wraps
 from typing import Optional, Any, Callable, TypeVar
 
 
@@ -20,6 +21,7 @@ def castarg(
     """Wrap a function to cast positional or keyword arguments to the given type."""
 
     def _wrapper(func: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        @wraps(func)
         def _inner(*args: Optional[Any], **kwargs: Optional[Any]) -> Any:
             if name is not None and pos is not None:
                 raise ValueError(
@@ -0,0 +1,19 @@
+import timeit
+from apogee.models import BayesianNetwork
+
+queries = [
+    [("HISTORY", "TRUE")],
+    [("CVP", "LOW"), ("BP", "HIGH")],
+    [("HISTORY", "FALSE"), ("HRBP", "NORMAL"), ("PAP", "HIGH")],
+]
+
+for propagation in ["shafer-shenoy", "hugin"]:
+    model = BayesianNetwork.from_hugin("data/alarm.net", propagation=propagation)
+    model.compile()
+
+    def query():
+        for x in queries:
+            list(model.iter_predict(x=x))
+
+    seconds = min(timeit.repeat(query, number=1, repeat=5)) / len(queries)
+    print(f"{propagation}: {seconds * 1000:.1f}ms per query")
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from apogee.core import plan_contraction
+from apogee.factors import DiscreteFactor, FactorSet
+
+
+def _einsum(scopes, tables, output):
+    letters = "abcdefghij"
+    inputs = ",".join("".join(letters[x] for x in scope) for scope in scopes)
+    return np.einsum(
+        inputs + "->" + "".join(letters[x] for x in output), *[t[0] for t in tables]
+    )
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_plan_contraction(seed):
+    rng = np.random.RandomState(seed)
+    cards = {x: int(rng.randint(2, 4)) for x in range(10)}
+    scopes = [
+        rng.choice(10, size=rng.randint(1, 4), replace=False)
+        for _ in range(rng.randint(2, 9))
+    ]
+    variables = np.unique(np.concatenate(scopes))
+    output = rng.choice(variables, size=min(2, len(variables)), replace=False)
+    tables = [rng.rand(1, *[cards[x] for x in scope]) for scope in scopes]
+
+    optimal = plan_contraction(scopes, cards, output)
+    greedy = plan_contraction(scopes, cards, output, exhaustive=0)
+    assert optimal.cost <= greedy.cost
+
+    for plan in (optimal, greedy):
+        table, scope = plan.execute(tables)
+        assert sorted(scope) == sorted(output)
+        assert table[0] == pytest.approx(_einsum(scopes, tables, scope))
+
+
+def test_factor_set_contract():
+    a = DiscreteFactor([0], [2], [0.1, 0.9])
+    b = DiscreteFactor([1, 0], [2, 2], [0.2, 0.8, 0.7, 0.3])
+    c = DiscreteFactor([2, 1], [3, 2], [0.1, 0.2, 0.3, 0.4, 0.5, 0.6])
+    factors = FactorSet(c, a, b)
+
+    expected = (a * b) * c
+    assert factors.product().parameters == pytest.approx(expected.parameters)
+
+    joint = expected.parameters.reshape(2, 2, 3)
+    assert factors.marginalise(0, 1).parameters == pytest.approx(joint.sum((0, 1)))
+    assert factors.maximise(1).parameters == pytest.approx(joint.max(1).ravel())
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+from apogee.factors import FactorSet
+from apogee.inference import CutsetConditioning
+from apogee.models import BayesianNetwork
+
+ASIA = os.path.join(os.path.dirname(__file__), "../../examples/data/asia.net")
+
+
+@pytest.mark.parametrize(
+    "max_bytes, processes", [(None, None), (200, None), (200, 2), (0, None)]
+)
+def test_cutset_conditioning_exact(max_bytes, processes):
+    model = BayesianNetwork.from_hugin(ASIA)
+    evidence = [[0, 0], [5, 1]]
+
+    tree = model.engine
+    tree.set_observations(evidence)
+    tree.propagate()
+    tree.calibrate()
+
+    kwargs = dict(max_bytes=max_bytes, processes=processes, batch_size=3)
+    if max_bytes == 0:
+        with pytest.raises(ValueError):
+            CutsetConditioning.from_factors(FactorSet(*model.factors), **kwargs)
+        return
+
+    engine = CutsetConditioning.from_factors(FactorSet(*model.factors), **kwargs)
+    engine.set_observations(evidence)
+
+    try:
+        assert len(engine.cutset) > 0
+        assert engine.log_evidence() == pytest.approx(tree.log_evidence(), abs=1e-5)
+        for variable in range(len(model.variables)):
+            expected = tree.marginal(variable).normalise().parameters
+            result = engine.marginal(variable).parameters
+            assert result == pytest.approx(expected, abs=1e-5)
+    finally:
+        engine.close()
+
+
+def test_cutset_conditioning_model():
+    model = BayesianNetwork.from_hugin(ASIA)
+    cutset = BayesianNetwork.from_hugin(
+        ASIA, inference="cutset", options={"max_bytes": 200}
+    )
+
+    x = (("xray", "yes"), ("smoke", "no"))
+    expected, result = model.predict(x), cutset.predict(x)
+    for name, marginal in expected.items():
+        assert np.allclose(list(result[name].values()), list(marginal.values()))
+
+
+def test_cutset_conditioning_model_close():
+    model = BayesianNetwork.from_hugin(
+        ASIA, inference="cutset", options={"max_bytes": 200, "processes": 2}
+    )
+    model.predict((("xray", "yes"),))
+
+    engine = model.engine
+    assert engine._pool is not None
+
+    # discarding the engine stops its worker processes.
+    model.add(model["asia"])
+    assert engine._pool is None
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from apogee.factors import DiscreteFactor, FactorSet
+from apogee.inference import GibbsSampler, JunctionTree
+
+
+def _factors(n=10):
+    # a random network without zeros, in which every chain can reach every state.
+    rng = np.random.RandomState(1)
+    cards = rng.randint(2, 4, size=n)
+    factors = []
+    for child in range(n):
+        scope = [child, *rng.choice(child, size=min(child, 2), replace=False)]
+        size = int(np.prod(cards[scope]))
+        factors.append(DiscreteFactor(scope, cards[scope], rng.rand(size) + 0.1))
+
+    return FactorSet(*factors)
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_gibbs_sampler_marginals(processes):
+    factors = _factors()
+    evidence = [[9, 1], [4, 0]]
+
+    tree = JunctionTree.from_factors(factors)
+    tree.set_observations(evidence)
+    tree.propagate()
+    tree.calibrate()
+
+    sampler = GibbsSampler.from_factors(
+        factors, chains=64, samples=1000, processes=processes, random_state=0
+    )
+    sampler.set_observations(evidence)
+
+    for variable in factors.vars:
+        expected = tree.marginal(variable).normalise().parameters
+        result = sampler.marginal(variable).parameters
+        assert result == pytest.approx(expected, abs=0.01)
+
+    report = sampler.diagnostics()
+    assert report[4] == {"ess": 64000.0, "r_hat": 1.0}
+    for variable, diagnostics in report.items():
+        assert diagnostics["r_hat"] < 1.05
+        assert diagnostics["ess"] > 1000
@@ -0,0 +1,354 @@
+import os
+
+import numpy as np
+import pytest
+
+from apogee.core import subset
+from apogee.factors import DiscreteFactor, FactorSet
+from apogee.inference import BatchExecutor, JunctionTree
+from apogee.models import BayesianNetwork
+
+ASIA = os.path.join(os.path.dirname(__file__), "../../examples/data/asia.net")
+
+
+def _factors():
+    return FactorSet(*BayesianNetwork.from_hugin(ASIA).factors)
+
+
+def test_junction_tree_maximal_cliques():
+    tree = JunctionTree.from_factors(_factors())
+    scopes = [factor.scope for factor in tree.factors]
+
+    assert len(scopes) < 8
+    for i, a in enumerate(scopes):
+        assert not any(subset(a, b) for j, b in enumerate(scopes) if i != j)
+
+    tree.validate()
+
+
+@pytest.mark.parametrize("propagation", ["shafer-shenoy", "hugin"])
+def test_junction_tree_marginals(propagation):
+    factors = _factors()
+    joint = factors.product()
+
+    tree = JunctionTree.from_factors(factors, propagation=propagation)
+    tree.propagate()
+    tree.calibrate()
+
+    for variable in factors.vars:
+        expected = joint.marginalise(*np.setdiff1d(joint.scope, [variable]))
+        marginal = tree.marginal(variable)
+        assert np.allclose(
+            marginal.normalise().parameters, expected.normalise().parameters, atol=1e-5
+        )
+
+
+@pytest.mark.parametrize("propagation", ["shafer-shenoy", "hugin"])
+def test_junction_tree_marginal_hosts(propagation):
+    # 1 and 2 are only in the separator of two larger cliques, so share it as a host.
+    rng = np.random.RandomState(0)
+    factors = FactorSet(
+        DiscreteFactor([0, 1, 2], [2, 3, 2], rng.dirichlet(np.ones(12))),
+        DiscreteFactor([1, 2, 3], [3, 2, 2], rng.dirichlet(np.ones(12))),
+        DiscreteFactor([3, 4], [2, 4], rng.dirichlet(np.ones(8))),
+    )
+    cards = {0: 2, 1: 3, 2: 2, 3: 2, 4: 4}
+
+    tree = JunctionTree.from_factors(factors, propagation=propagation)
+    cliques = [factor.scope for factor in tree.factors]
+    hosts = [(node,) for node in range(len(cliques))]
+    for child, separator in enumerate(tree._separators):
+        if separator is not None:
+            hosts.append((int(tree._parents[child]), child))
+
+    def scope(host):
+        if len(host) == 1:
+            return cliques[host[0]]
+        return tree._separators[host[1]]
+
+    def size(host):
+        return int(np.prod([cards[x] for x in scope(host)]))
+
+    for variable in factors.vars:
+        host = tree._marginal_host(variable)
+        smallest = min(size(x) for x in hosts if variable in scope(x))
+        assert variable in scope(host)
+        assert size(host) == smallest
+
+    assert tree._marginal_host(1) == tree._marginal_host(2)
+    assert len(tree._marginal_host(1)) == 2
+
+    evidence = [[4, 3]]
+    joint = factors.product().reduce(*evidence)
+    tree.set_observations(evidence)
+    tree.propagate()
+    tree.calibrate()
+
+    variables = [2, 0, 1, 3]
+    for variable, marginal in zip(variables, tree.marginals(*variables)):
+        expected = joint.marginalise(*np.setdiff1d(joint.scope, [variable]))
+        assert list(marginal.scope) == [variable]
+        assert np.allclose(
+            marginal.normalise().parameters, expected.normalise().parameters, atol=1e-6
+        )
+
+
+def test_junction_tree_incremental_evidence():
+    factors = _factors()
+
+    tree = JunctionTree.from_factors(factors)
+    tree.propagate()
+    tree.calibrate()
+
+    for evidence in ([[0, 0]], [[0, 1]], [[0, 1], [5, 0]], [[5, 1]], []):
+        tree.set_observations(evidence)
+        tree.propagate()
+        tree.calibrate()
+
+        fresh = JunctionTree.from_factors(factors)
+        fresh.update_observations(evidence)
+        fresh.propagate()
+        fresh.calibrate()
+
+        for variable in factors.vars:
+            assert np.allclose(
+                tree.marginal(variable).normalise().parameters,
+                fresh.marginal(variable).normalise().parameters,
+                atol=1e-5,
+            )
+
+
+@pytest.mark.parametrize("propagation", ["shafer-shenoy", "hugin"])
+def test_junction_tree_joint(propagation):
+    factors = _factors()
+    joint = factors.product().reduce([5, 0])
+
+    tree = JunctionTree.from_factors(factors, propagation=propagation)
+    tree.set_observations([[5, 0]])
+    tree.propagate()
+    tree.calibrate()
+
+    for variables in [(0, 4), (0, 1, 4), (3, 6)]:
+        expected = joint.marginalise(*np.setdiff1d(joint.scope, variables))
+        result = tree.joint(*variables)
+        assert np.all(result.scope == expected.scope)
+        assert np.allclose(
+            result.parameters / result.parameters.sum(),
+            expected.parameters / expected.parameters.sum(),
+            atol=1e-5,
+        )
+
+
+def test_junction_tree_mpe():
+    factors = _factors()
+
+    for evidence in ([], [[0, 0]], [[0, 0], [1, 1], [5, 0]]):
+        joint = factors.product()
+        if len(evidence) > 0:
+            joint = joint.reduce(*evidence)
+        expected = dict(zip(joint.scope.tolist(), joint.mpe().tolist()))
+
+        tree = JunctionTree.from_factors(factors)
+        tree.set_observations(evidence)
+        assignment, value = tree.mpe()
+
+        assert assignment == expected
+        assert np.isclose(value, np.log(joint.max()), atol=1e-4)
+
+
+def test_junction_tree_top_k():
+    factors = _factors()
+    joint = factors.product().reduce([0, 0], [5, 0])
+    expected = np.sort(joint.parameters)[::-1][:10]
+
+    tree = JunctionTree.from_factors(factors)
+    tree.set_observations([[0, 0], [5, 0]])
+    explanations = tree.top_k(10)
+
+    values = [value for _, value in explanations]
+    assert np.allclose(values, np.log(expected), atol=1e-4)
+    for assignment, value in explanations:
+        index = joint.index([assignment[x] for x in joint.scope])
+        assert np.isclose(np.log(joint.parameters[int(index)]), value, atol=1e-4)
+
+
+def test_junction_tree_mpe_long_chain():
+    # the value of any assignment of a long chain underflows in single precision.
+    rng = np.random.RandomState(0)
+    n = 200
+    factors = [DiscreteFactor([0], [3], rng.dirichlet([3, 3, 3]))]
+    for child in range(1, n):
+        table = rng.dirichlet([3, 3, 3], size=3).T
+        factors.append(DiscreteFactor([child, child - 1], [3, 3], table.ravel()))
+
+    tables = [factor.parameters.reshape(factor.cards) for factor in factors]
+
+    def log_value(assignment):
+        total = np.log(tables[0][assignment[0]])
+        for child in range(1, n):
+            total += np.log(tables[child][assignment[child], assignment[child - 1]])
+        return total
+
+    tree = JunctionTree.from_factors(FactorSet(*factors))
+    tree.set_observations([[0, 1], [n - 1, 0]])
+
+    assignment, value = tree.mpe()
+    assert value < np.log(np.finfo(np.float32).tiny)
+    assert value == pytest.approx(log_value(assignment), abs=1e-3)
+
+    explanations = tree.top_k(2)
+    assert len(explanations) == 2
+    assert explanations[0][1] == pytest.approx(value, abs=1e-3)
+    assert explanations[1][1] <= explanations[0][1]
+    for assignment, value in explanations:
+        assert value == pytest.approx(log_value(assignment), abs=1e-3)
+
+
+def test_junction_tree_propagate_batch():
+    factors = _factors()
+    tree = JunctionTree.from_factors(factors)
+
+    evidence = {0: np.array([-1, 0, 1, 0]), 5: np.array([-1, -1, 1, 0])}
+    marginals = tree.propagate_batch(evidence)
+
+    for row in range(4):
+        tree.set_observations(
+            [[k, v[row]] for k, v in evidence.items() if v[row] >= 0]
+        )
+        tree.propagate()
+        tree.calibrate()
+
+        for variable in factors.vars:
+            assert np.allclose(
+                marginals[variable][row],
+                tree.marginal(variable).normalise().parameters,
+                atol=1e-5,
+            )
+
+
+def test_batch_executor_matches_propagate_batch():
+    factors = _factors()
+    tree = JunctionTree.from_factors(factors)
+
+    evidence = {0: np.array([-1, 0, 1, 0, 1]), 5: np.array([-1, -1, 1, 0, 0])}
+    expected = tree.propagate_batch(evidence)
+
+    with BatchExecutor(tree, processes=1, chunk_size=2) as executor:
+        chunks = list(executor.map(evidence))
+
+    assert len(chunks) == 3
+    for variable in factors.vars:
+        result = np.concatenate(
+            [
+                np.broadcast_to(c[variable], (n, c[variable].shape[1]))
+                for c, n in zip(chunks, [2, 2, 1])
+            ]
+        )
+        assert np.allclose(result, np.broadcast_to(expected[variable], result.shape))
+
+
+@pytest.mark.parametrize("propagation", ["shafer-shenoy", "hugin"])
+def test_junction_tree_forest(propagation):
+    asia = list(_factors())
+    copy = [
+        DiscreteFactor(factor.scope + 8, factor.cards, factor.parameters)
+        for factor in asia
+    ]
+    isolated = DiscreteFactor([16], [3], [0.2, 0.3, 0.5])
+    factors = FactorSet(*asia, *copy, isolated)
+
+    tree = JunctionTree.from_factors(factors, propagation=propagation)
+    assert len(tree._roots()) == 3
+
+    tree.set_observations([[0, 0], [13, 1]])
+    tree.propagate([2])
+    tree.calibrate([2])
+
+    # only the tree hosting the query variable has been propagated.
+    with pytest.raises(ValueError):
+        tree.marginal(10)
+
+    tree.propagate()
+    tree.calibrate()
+
+    for offset, evidence in ((0, [[0, 0]]), (8, [[5, 1]])):
+        fresh = JunctionTree.from_factors(_factors())
+        fresh.set_observations(evidence)
+        fresh.propagate()
+        fresh.calibrate()
+
+        for variable in range(8):
+            assert np.allclose(
+                tree.marginal(variable + offset).normalise().parameters,
+                fresh.marginal(variable).normalise().parameters,
+                atol=1e-5,
+            )
+    assert np.allclose(tree.marginal(16).normalise().parameters, [0.2, 0.3, 0.5])
+
+    marginals = tree.propagate_batch({0: np.array([0, 1])}, variables=[2, 16])
+    assert np.allclose(marginals[16], [[0.2, 0.3, 0.5]])
+
+
+def test_junction_tree_targeted_propagation():
+    factors = _factors()
+
+    tree = JunctionTree.from_factors(factors)
+    tree.set_observations([[0, 0], [5, 1]])
+    tree.propagate([3])
+    tree.calibrate([3])
+
+    sent = [message for message in tree._messages if message is not None]
+    assert len(sent) < 2 * len(tree.edges)
+
+    fresh = JunctionTree.from_factors(factors)
+    fresh.set_observations([[0, 0], [5, 1]])
+    fresh.propagate()
+    fresh.calibrate()
+
+    assert np.allclose(
+        tree.marginal(3).normalise().parameters,
+        fresh.marginal(3).normalise().parameters,
+        atol=1e-5,
+    )
+
+    # messages needed by later queries are computed on demand.
+    tree.propagate([6])
+    tree.calibrate([6])
+    assert np.allclose(
+        tree.marginal(6).normalise().parameters,
+        fresh.marginal(6).normalise().parameters,
+        atol=1e-5,
+    )
+    assert np.allclose(tree.joint(3, 6).parameters, fresh.joint(3, 6).parameters)
+
+
+@pytest.mark.parametrize("propagation", ["shafer-shenoy", "hugin"])
+def test_junction_tree_log_evidence(propagation):
+    factors = _factors()
+    evidence = [[0, 0], [5, 1]]
+
+    tree = JunctionTree.from_factors(factors, propagation=propagation)
+    tree.set_observations(evidence)
+    tree.propagate()
+    tree.calibrate()
+
+    expected = np.log(factors.product().reduce(*evidence).parameters.sum())
+    assert np.isclose(tree.log_evidence(), expected, atol=1e-5)
+
+    # a long chain of unlikely observations underflows single precision.
+    n = 120
+    chain = [DiscreteFactor([0], [2], [0.5, 0.5])]
+    chain += [
+        DiscreteFactor([i - 1, i], [2, 2], [0.9, 0.1, 0.2, 0.8]) for i in range(1, n)
+    ]
+
+    tree = JunctionTree.from_factors(FactorSet(*chain), propagation=propagation)
+    tree.set_observations([[i, i % 2] for i in range(n - 1)])
+    tree.propagate()
+    tree.calibrate()
+
+    expected = np.log(0.5) + sum(
+        np.log(0.1 if i % 2 else 0.2) for i in range(1, n - 1)
+    )
+    assert np.isclose(tree.log_evidence(), expected, rtol=1e-6)
+    assert np.allclose(tree.marginal(n - 1).normalise().parameters, [0.9, 0.1])
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pytest
+
+from apogee.factors import DiscreteFactor, FactorSet
+from apogee.inference import JunctionTree, LoopyBeliefPropagation
+from apogee.models import BayesianNetwork
+
+ASIA = os.path.join(os.path.dirname(__file__), "../../examples/data/asia.net")
+
+
+def _tree(n=12):
+    # a random tree of binary and ternary variables, on which propagation is exact.
+    rng = np.random.RandomState(0)
+    cards = rng.randint(2, 4, size=n)
+    factors = [DiscreteFactor([0], [cards[0]], rng.rand(cards[0]))]
+    for child in range(1, n):
+        parent = rng.randint(child)
+        size = cards[child] * cards[parent]
+        factors.append(
+            DiscreteFactor(
+                [child, parent], [cards[child], cards[parent]], rng.rand(size)
+            )
+        )
+
+    return FactorSet(*factors)
+
+
+@pytest.mark.parametrize("mode", ["synchronous", "residual"])
+@pytest.mark.parametrize("damping", [0.0, 0.5])
+def test_loopy_belief_propagation_exact_on_trees(mode, damping):
+    factors = _tree()
+    evidence = [[3, 1], [7, 0]]
+
+    tree = JunctionTree.from_factors(factors)
+    tree.set_observations(evidence)
+    tree.propagate()
+    tree.calibrate()
+
+    graph = LoopyBeliefPropagation.from_factors(
+        factors, mode=mode, damping=damping, tolerance=1e-8, max_iterations=500
+    )
+    graph.set_observations(evidence)
+    graph.propagate()
+
+    assert graph.converged
+    for variable in factors.vars:
+        expected = tree.marginal(variable).normalise().parameters
+        result = graph.marginal(variable).parameters
+        assert result == pytest.approx(expected, abs=1e-5)
+
+
+def test_loopy_belief_propagation_model(tmp_path):
+    model = BayesianNetwork.from_hugin(ASIA)
+    loopy = BayesianNetwork.from_hugin(
+        ASIA, inference="loopy", options={"mode": "residual"}
+    )
+
+    x = (("xray", "yes"), ("smoke", "no"))
+    expected, result = model.predict(x), loopy.predict(x)
+    for name, marginal in expected.items():
+        for state, p in marginal.items():
+            assert result[name][state] == pytest.approx(p, abs=0.01)
+
+    # models over the memory ceiling fall back to loopy propagation.
+    with pytest.warns(UserWarning, match="falling back"):
+        model.compile(max_bytes=0, fallback=True)
+    assert isinstance(model.engine, LoopyBeliefPropagation)
+
+    # the fallback engine has no junction tree arrays to save.
+    with pytest.raises(ValueError):
+        model.save(str(tmp_path / "asia.npz"))
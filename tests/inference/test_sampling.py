@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+
+from apogee.factors import FactorSet
+from apogee.inference import ForwardSampler, JunctionTree, LikelihoodWeighting
+from apogee.models import BayesianNetwork
+
+ASIA = os.path.join(os.path.dirname(__file__), "../../examples/data/asia.net")
+
+
+def _factors():
+    return FactorSet(*BayesianNetwork.from_hugin(ASIA).factors)
+
+
+def _exact(factors, evidence):
+    tree = JunctionTree.from_factors(factors)
+    tree.set_observations(evidence)
+    tree.propagate()
+    tree.calibrate()
+    return tree
+
+
+def test_forward_sampler_marginals():
+    factors = _factors()
+    tree = _exact(factors, [])
+
+    samples = ForwardSampler.from_factors(factors).sample(
+        200000, random_state=np.random.RandomState(0)
+    )
+
+    for variable in factors.vars:
+        expected = tree.marginal(variable).normalise().parameters
+        result = np.bincount(samples[variable], minlength=len(expected)) / 200000
+        assert result == pytest.approx(expected, abs=0.01)
+
+
+def test_likelihood_weighting_marginals():
+    factors = _factors()
+    evidence = [[0, 0], [5, 1]]
+    tree = _exact(factors, evidence)
+
+    engine = LikelihoodWeighting.from_factors(factors, samples=200000, random_state=0)
+    engine.set_observations(evidence)
+
+    for variable in factors.vars:
+        expected = tree.marginal(variable).normalise().parameters
+        assert engine.marginal(variable).parameters == pytest.approx(expected, abs=0.01)
+
+    assert engine.log_evidence() == pytest.approx(tree.log_evidence(), abs=0.05)
+    assert 0 < engine.effective_samples <= 200000
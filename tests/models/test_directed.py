@@ -0,0 +1,255 @@
+import os
+
+import pytest
+from pandas import DataFrame, notna
+
+from apogee.models import BayesianNetwork
+
+ASIA = os.path.join(os.path.dirname(__file__), "../../examples/data/asia.net")
+
+
+@pytest.mark.parametrize(
+    "targets, observed, expected",
+    [
+        (["tub"], [], {"tub", "asia"}),
+        (["tub"], ["xray"], {"tub", "asia", "either", "xray", "lung", "smoke"}),
+        (["tub"], ["either", "xray"], {"tub", "asia", "either", "lung", "smoke"}),
+    ],
+)
+def test_directed_model_relevant(targets, observed, expected):
+    model = BayesianNetwork.from_hugin(ASIA)
+    assert model.relevant(targets, observed) == expected
+
+
+def test_directed_model_prune():
+    model = BayesianNetwork.from_hugin(ASIA)
+    pruned = BayesianNetwork.from_hugin(ASIA, prune=True)
+
+    queries = [
+        ((("xray", "yes"),), ("tub", "lung")),
+        ((("smoke", "no"), ("dysp", "yes")), ("bronc",)),
+        ((), ("asia", "xray")),
+    ]
+
+    for x, marginals in queries:
+        expected = model.predict(x, marginals=marginals)
+        result = pruned.predict(x, marginals=marginals)
+        for name in marginals:
+            assert result[name] == pytest.approx(expected[name], abs=1e-5)
+
+    # the first and last queries share a relevant set, and so an engine.
+    assert len(pruned._engines) == 2
+
+
+@pytest.mark.parametrize("propagation", ["shafer-shenoy", "hugin"])
+def test_directed_model_score(propagation):
+    model = BayesianNetwork.from_hugin(ASIA, propagation=propagation)
+
+    complete = {name: variable.states[0] for name, variable in model.variables.items()}
+    df = DataFrame(
+        [complete, {"xray": "yes", "smoke": "no"}, {"dysp": "no"}, {}],
+        columns=list(model.variables),
+    )
+
+    scores = model.score(df, batch_size=2)
+
+    for i, row in df.iterrows():
+        x = tuple((k, v) for k, v in row.items() if notna(v))
+        assert scores[i] == pytest.approx(model.log_likelihood(x), abs=1e-5)
+
+    assert scores[3] == pytest.approx(0.0, abs=1e-5)
+
+
+def test_directed_model_save_load(tmp_path):
+    filename = str(tmp_path / "asia.npz")
+
+    model = BayesianNetwork.from_hugin(ASIA).compile(cache=filename)
+    loaded = BayesianNetwork.load(filename)
+
+    assert loaded.checksum() == model.checksum()
+    assert not next(loaded.engine.factors).parameters.flags.owndata
+
+    x = (("xray", "yes"), ("smoke", "no"))
+    expected = model.predict(x)
+    result = loaded.predict(x)
+    for name in model.variables:
+        assert result[name] == pytest.approx(expected[name], abs=1e-5)
+
+    # the memory ceiling applies to cached engines too.
+    assert loaded.engine.table_bytes == model.complexity()["table_bytes"]
+    with pytest.raises(ValueError):
+        BayesianNetwork.from_hugin(ASIA).compile(cache=filename, max_bytes=0)
+
+    # a model with different parameters does not reuse the cached engine.
+    other = BayesianNetwork.from_hugin(ASIA)
+    other["asia"].parameters = [0.5, 0.5]
+    other.compile(cache=filename)
+
+    assert other.predict(marginals=("asia",))["asia"]["yes"] == pytest.approx(0.5)
+    assert BayesianNetwork.load(filename).checksum() == other.checksum()
+
+
+def test_directed_model_complexity():
+    model = BayesianNetwork.from_hugin(ASIA)
+    report = model.complexity()
+
+    assert report["treewidth"] == 2
+    assert report["max_clique_states"] == 8
+
+    # at least a potential and a belief for each clique.
+    tree = model.compile().engine
+    assert report["table_bytes"] > sum(2 * f.parameters.nbytes for f in tree._factors)
+
+    with pytest.raises(ValueError):
+        model.compile(max_bytes=report["table_bytes"] - 1)
+
+
+def test_directed_model_sample():
+    model = BayesianNetwork.from_hugin(ASIA)
+    df = model.sample(50000, batch_size=20000, random_state=0)
+
+    assert list(df.columns) == list(model.variables)
+    assert len(df) == 50000
+
+    expected = model.predict()
+    for name, marginal in expected.items():
+        frequencies = df[name].value_counts(normalize=True)
+        for state, p in marginal.items():
+            assert frequencies[state] == pytest.approx(p, abs=0.02)
+
+
+def test_directed_model_lookups():
+    model = BayesianNetwork.from_hugin(ASIA)
+    names = list(model.variables)
+
+    for i, name in enumerate(names):
+        assert model.index(name) == i and model.name(i) == name
+        for j, state in enumerate(model[name].states):
+            assert model.state(name, state) == j
+
+    with pytest.raises(ValueError):
+        model.state("xray", "maybe")
+
+    # removing a variable moves the variables after it down an index.
+    model.remove(names[0])
+    assert names[0] not in model
+    assert [model.index(name) for name in names[1:]] == list(range(len(names) - 1))
+    with pytest.raises(IndexError):
+        model.name(len(names) - 1)
+
+
+def test_directed_model_prune_batch():
+    model = BayesianNetwork.from_hugin(ASIA)
+    pruned = BayesianNetwork.from_hugin(ASIA, prune=True)
+
+    df = DataFrame(
+        {
+            "xray": ["yes", "no", None, "yes"],
+            "smoke": ["no", None, "yes", "yes"],
+            "asia": ["yes", "yes", "no", "yes"],
+        }
+    )
+    # 'smoke' is missing in one row, so its table cannot be pruned from the query.
+    for marginals in [("tub", "bronc", "dysp"), ("bronc",)]:
+        expected = model.predict_batch(df, marginals=marginals)
+        result = pruned.predict_batch(df, marginals=marginals)
+        assert result.values == pytest.approx(expected.values, abs=1e-5)
+
+    # queries with no relevant variables use the full engine.
+    assert pruned.log_likelihood() == pytest.approx(0.0, abs=1e-6)
+    assert pruned.predict(marginals=("unknown",)) == {}
+
+
+def test_directed_model_close_engines():
+    model = BayesianNetwork.from_hugin(ASIA, prune=True, workers=2)
+
+    model.predict((("xray", "yes"),), marginals=("tub", "lung"))
+    model.predict(marginals=("dysp",))
+    engines = [model.engine, *model._engines.values()]
+    assert any(engine._executor is not None for engine in engines)
+
+    # replacing a variable discards (and stops the threads of) every engine.
+    model.add(model["asia"])
+    assert all(engine._executor is None for engine in engines)
+
+
+@pytest.mark.parametrize("inference", ["loopy", "gibbs", "likelihood-weighting"])
+def test_directed_model_exact_queries(inference):
+    model = BayesianNetwork.from_hugin(ASIA, inference=inference)
+
+    x = (("xray", "yes"),)
+    df = DataFrame({"xray": ["yes", None], "smoke": ["no", "yes"]})
+    queries = [
+        lambda: model.mpe(x),
+        lambda: model.top_k(2, x),
+        lambda: model.joint(("tub", "lung"), x),
+        lambda: model.log_likelihood(x),
+        lambda: model.score(df),
+        lambda: model.predict_batch(df, marginals=("tub",)),
+    ]
+
+    name = type(model.engine).__name__
+    for query in queries:
+        with pytest.raises(ValueError, match="{0} engine".format(name)):
+            query()
+
+
+def test_directed_model_fallback():
+    model = BayesianNetwork.from_hugin(ASIA)
+    with pytest.warns(UserWarning, match="falling back"):
+        model.compile(max_bytes=0, fallback=True)
+
+    # marginals are still available, approximately, from the fallback engine.
+    x = (("xray", "yes"),)
+    marginal = model.predict(x, marginals=("tub",))["tub"]
+    assert sum(marginal.values()) == pytest.approx(1.0)
+
+    df = DataFrame({"xray": ["yes", None], "smoke": ["no", "yes"]})
+    queries = [
+        lambda: model.mpe(x),
+        lambda: model.top_k(2, x),
+        lambda: model.joint(("tub", "lung"), x),
+        lambda: model.log_likelihood(x),
+        lambda: model.score(df),
+        lambda: model.predict_batch(df, marginals=("tub",)),
+    ]
+    for query in queries:
+        with pytest.raises(ValueError, match="LoopyBeliefPropagation engine"):
+            query()
+
+
+def test_directed_model_invalidate():
+    model = BayesianNetwork.from_hugin(ASIA)
+    cache = BayesianNetwork.predict.__wrapped__.__wrapped__
+    df = model.sample(1000, random_state=0)
+
+    builds, build = [], model._build
+
+    def counted(*args, **kwargs):
+        builds.append(args)
+        return build(*args, **kwargs)
+
+    model._build = counted
+
+    # queries with different evidence and marginals share the compiled engine.
+    engine = model.engine
+    list(model.iter_predict((("xray", "yes"),), marginals=("tub",)))
+    list(model.iter_predict((("smoke", "no"),)))
+    list(model.iter_predict())
+    assert model.engine is engine
+    assert len(builds) == 1
+
+    updates = [
+        lambda: model.fit(df),
+        lambda: model.add(model["asia"]),
+        lambda: model.remove("dysp"),
+    ]
+    for update in updates:
+        model.predict((("xray", "yes"),))
+        assert model.compiled and cache.cache_info().currsize > 0
+
+        update()
+        assert not model.compiled
+        assert cache.cache_info().currsize == 0
+
+    assert "dysp" not in model.predict()